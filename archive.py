@@ -0,0 +1,116 @@
+import io
+import os
+import queue
+import threading
+import time
+
+
+ARCHIVE_FORMATS = ("zip", "tar")
+
+# Rendered files waiting for the writer thread before rendering has to wait
+ARCHIVE_QUEUE_SIZE = 64
+
+
+def archive_filename(archive, filename=""):
+    """Name of the archive file, e.g. pdfs.zip when no filename is set"""
+    return filename or f"pdfs.{archive}"
+
+
+class ArchiveWriter:
+    """Streams rendered PDFs into one ZIP or TAR file from a writer thread
+
+    add() hands a file to the thread through a bounded queue, so rendering
+    only waits when the disk falls that far behind. PDFs are compressed
+    already; ZIP entries are stored as they are and the TAR is not
+    compressed. prefix is written before every file's bytes, e.g. the
+    template in spliced mode.
+    """
+
+    def __init__(self, path, archive, prefix=b"", metrics=None):
+        if archive not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {archive}")
+        self.path = path
+        self.prefix = prefix
+        self.metrics = metrics
+        self.error = None
+        self._mtime = time.time()
+        if archive == "zip":
+            import zipfile
+            self._archive = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED)
+            self._info = zipfile.ZipInfo
+            self._add = self._add_zip
+        else:
+            import tarfile
+            self._archive = tarfile.open(path, "w", format=tarfile.PAX_FORMAT)
+            self._info = tarfile.TarInfo
+            self._add = self._add_tar
+        self._queue = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, result):
+        """Queue one (filename, PDF bytes) result of RenderJob.process_row()"""
+        if self.error is not None:
+            raise self.error
+        self._queue.put(result)
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._archive.close()
+        if self.metrics is not None:
+            self.metrics.count("bytes_written", os.path.getsize(self.path))
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                # Keep draining so add() never blocks on a dead writer
+                continue
+            try:
+                self._add(*item)
+            except Exception as e:
+                self.error = e
+
+    def _add_zip(self, filename, data):
+        info = self._info(filename, time.localtime(self._mtime)[:6])
+        info.compress_type = self._archive.compression
+        info.file_size = len(self.prefix) + len(data)
+        with self._archive.open(info, "w") as entry:
+            entry.write(self.prefix)
+            entry.write(data)
+
+    def _add_tar(self, filename, data):
+        info = self._info(filename)
+        info.size = len(self.prefix) + len(data)
+        info.mtime = self._mtime
+        self._archive.addfile(info, io.BufferedReader(_Parts(self.prefix, data)))
+
+
+class _Parts(io.RawIOBase):
+    """Reads the prefix and then the data as one file, without joining them"""
+
+    def __init__(self, *parts):
+        self.parts = [memoryview(part) for part in parts if len(part)]
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.parts:
+            return 0
+        part = self.parts[0]
+        count = min(len(buffer), len(part))
+        buffer[:count] = part[:count]
+        if count == len(part):
+            self.parts.pop(0)
+        else:
+            self.parts[0] = part[count:]
+        return count
@@ -0,0 +1,297 @@
+"""Benchmark suite for the rendering pipeline.
+
+Generates synthetic CSVs, templates and letters, renders every combination
+headlessly with generate_documents and writes the results as JSON:
+
+    python bench.py --output bench.json
+    python bench.py --rows 1000 --baseline bench.json
+
+Each case runs in its own process so peak RSS and caches are per case.
+Files mode writes one PDF per row; the output of a case is deleted once it
+has been measured, but 100k rows with the large template still need several
+GB of free disk while that case runs.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROW_COUNTS = (1000, 10000, 100000)
+COLUMN_COUNTS = (5, 200)
+TEMPLATE_SIZES = ("small", "medium", "large")
+LETTERS = ("plain", "formatted")
+
+# Columns every generated CSV has, used by the letters and filenames
+BASE_COLUMNS = ("name", "age", "city", "company", "reference")
+CITIES = ("Madrid", "Barcelona", "Sevilla", "Valencia", "Bilbao", "Zaragoza")
+
+# Side of the random (incompressible) image in each template, in pixels
+TEMPLATE_IMAGE_SIDES = {"small": 0, "medium": 128, "large": 400}
+
+PARAGRAPH = (
+    "We are writing to you about reference {reference} held by {company}. "
+    "According to our records you are {age} years old and currently living in {city}. "
+    "Please review the enclosed statement carefully and let us know within thirty days "
+    "if any of the details shown are not correct, so that we can update our files. "
+)
+
+# Rows/s may drop this much against the baseline before a case is flagged
+DEFAULT_THRESHOLD = 0.10
+
+
+def make_csv(path, rows, columns):
+    rng = random.Random(rows * 1000 + columns)
+    extra = [f"col_{i:03d}" for i in range(columns - len(BASE_COLUMNS))]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(list(BASE_COLUMNS) + extra)
+        for i in range(rows):
+            writer.writerow(
+                [f"Person {i}", str(rng.randint(18, 90)), rng.choice(CITIES), f"Company {i % 97}", f"REF-{i:07d}"]
+                + [f"value {i}-{j}" for j in range(len(extra))]
+            )
+
+
+def make_template(path, size):
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    c = canvas.Canvas(path, pagesize=letter)
+    c.setFont("Helvetica-Bold", 16)
+    c.drawString(72, letter[1] - 72, "CSV2PDF Benchmark Letterhead")
+    c.setLineWidth(1)
+    c.line(72, letter[1] - 80, letter[0] - 72, letter[1] - 80)
+    side = TEMPLATE_IMAGE_SIDES[size]
+    if side:
+        from PIL import Image
+        image = Image.frombytes("RGB", (side, side), random.Random(side).randbytes(side * side * 3))
+        image_path = path + ".png"
+        image.save(image_path)
+        c.drawImage(image_path, letter[0] - 72 - 96, letter[1] - 72 - 96, 96, 96)
+        os.remove(image_path)
+    c.save()
+
+
+def make_letter(kind):
+    # About 2 KB of text with a handful of tags
+    text = "\\tDear {name},\\n\\n" + PARAGRAPH * 6 + "\\n\\n\\tBest regards"
+    if kind == "plain":
+        return text
+    # Heavy formatting: every few words toggle bold, italic or underline
+    words = text.split(" ")
+    tags = ("b", "i", "u")
+    for i in range(0, len(words), 3):
+        tag = tags[(i // 3) % len(tags)]
+        words[i] = f"<{tag}>{words[i]}</{tag}>"
+    return " ".join(words)
+
+
+def build_cases(args):
+    cases = []
+    for rows in args.rows:
+        for columns in args.columns:
+            for template in args.templates:
+                for letter_kind in args.letters:
+                    cases.append({
+                        "id": f"{rows}rows-{columns}cols-{template}-{letter_kind}",
+                        "rows": rows,
+                        "columns": columns,
+                        "template": template,
+                        "letter": letter_kind,
+                        "workers": args.workers,
+                        "output_mode": args.output_mode,
+                    })
+    return cases
+
+
+def prepare_fixtures(cases, workdir):
+    for case in cases:
+        csv_path = os.path.join(workdir, f"data-{case['rows']}-{case['columns']}.csv")
+        if not os.path.exists(csv_path):
+            make_csv(csv_path, case["rows"], case["columns"])
+        template_path = os.path.join(workdir, f"template-{case['template']}.pdf")
+        if not os.path.exists(template_path):
+            make_template(template_path, case["template"])
+        case["csv_path"] = csv_path
+        case["template_path"] = template_path
+        case["output_dir"] = os.path.join(workdir, "output")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_bytes():
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_case(case):
+    """Render one case in this process and return its measurements"""
+    from render import RenderJob, generate_documents
+    from richtext import parse_markup
+
+    shutil.rmtree(case["output_dir"], ignore_errors=True)
+    os.makedirs(case["output_dir"])
+    job = RenderJob(
+        case["template_path"], case["output_dir"], "letter_{reference}", parse_markup(make_letter(case["letter"])),
+        "Helvetica", "11", "10", "15", "80", output_mode=case["output_mode"]
+    )
+
+    # Time between progress callbacks is the latency of each row (of each
+    # chunk, spread over its rows, when running with several workers)
+    latencies = []
+    previous = [0, time.perf_counter()]
+
+    def progress(done):
+        now = time.perf_counter()
+        rows = done - previous[0]
+        latencies.extend([(now - previous[1]) / rows] * rows)
+        previous[:] = [done, now]
+
+    started = time.perf_counter()
+    count = generate_documents(job, case["csv_path"], case["workers"], progress=progress)
+    elapsed = time.perf_counter() - started
+
+    output_bytes = 0
+    for entry in os.scandir(case["output_dir"]):
+        output_bytes += entry.stat().st_size
+    shutil.rmtree(case["output_dir"], ignore_errors=True)
+
+    latencies.sort()
+    return {
+        "rows": count,
+        "seconds": elapsed,
+        "rows_per_second": count / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p90": percentile(latencies, 0.90) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": (latencies[-1] if latencies else 0.0) * 1000,
+        },
+        "peak_rss_bytes": peak_rss_bytes(),
+        "output_bytes": output_bytes,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(baseline, results, threshold):
+    """Return a message for every case whose rows/s fell more than threshold below baseline"""
+    previous = {case["id"]: case for case in baseline.get("cases", []) if "rows_per_second" in case}
+    regressions = []
+    for case in results["cases"]:
+        old = previous.get(case["id"])
+        if old is None or "rows_per_second" not in case or not old["rows_per_second"]:
+            continue
+        change = case["rows_per_second"] / old["rows_per_second"] - 1
+        if change < -threshold:
+            regressions.append(
+                f"{case['id']}: {old['rows_per_second']:.1f} -> {case['rows_per_second']:.1f} rows/s ({change:+.1%})"
+            )
+    return regressions
+
+
+def parse_list(kind):
+    return lambda value: [kind(item) for item in value.split(",") if item]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the CSV2PDF rendering pipeline.")
+    parser.add_argument("--rows", type=parse_list(int), default=list(ROW_COUNTS), help="comma separated row counts")
+    parser.add_argument("--columns", type=parse_list(int), default=list(COLUMN_COUNTS), help="comma separated column counts")
+    parser.add_argument("--templates", type=parse_list(str), default=list(TEMPLATE_SIZES), help="comma separated template sizes: small, medium, large")
+    parser.add_argument("--letters", type=parse_list(str), default=list(LETTERS), help="comma separated letters: plain, formatted")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes per case (default: 1)")
+    parser.add_argument("--output-mode", default="files", help="files, merged or spliced (default: files)")
+    parser.add_argument("--workdir", help="keep generated CSVs and templates here between runs")
+    parser.add_argument("--output", default="bench_results.json", help="results JSON (default: bench_results.json)")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed rows/s drop against the baseline (default: 0.10)")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.run_case:
+        # Child process: run a single case and report it on stdout
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        return 0
+
+    for columns in args.columns:
+        if columns < len(BASE_COLUMNS):
+            raise SystemExit(f"Each CSV needs at least {len(BASE_COLUMNS)} columns")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="csv2pdf-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        cases = build_cases(args)
+        prepare_fixtures(cases, workdir)
+
+        results = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "cases": [],
+        }
+        for case in cases:
+            print(f"{case['id']} ...", end=" ", flush=True)
+            child = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)],
+                capture_output=True, text=True
+            )
+            entry = {key: case[key] for key in ("id", "rows", "columns", "template", "letter", "workers", "output_mode")}
+            if child.returncode == 0:
+                entry.update(json.loads(child.stdout.strip().splitlines()[-1]))
+                print(f"{entry['rows_per_second']:.1f} rows/s, p99 {entry['latency_ms']['p99']:.1f} ms")
+            else:
+                entry["error"] = child.stderr.strip().splitlines()[-1] if child.stderr.strip() else "failed"
+                print(f"error: {entry['error']}")
+            results["cases"].append(entry)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for message in regressions:
+            print(f"Regression: {message}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+import argparse
+import os
+import sys
+import time
+from manifest import Manifest
+from metrics import Metrics
+from archive import ARCHIVE_FORMATS
+from richtext import RichText, parse_markup
+from settings import OUTPUT_MODES, read_settings
+
+
+def rich_text_from_settings(settings):
+    # Letters saved by the GUI keep their formatting as character ranges;
+    # settings written by hand can use <b>, <i> and <u> markup instead
+    format_ranges = settings["text_format_ranges"]
+    if any(format_ranges.values()):
+        return RichText(settings["text_content"], format_ranges)
+    return parse_markup(settings["text_content"])
+
+
+def load_command_settings(args):
+    if not os.path.exists(args.settings):
+        raise ValueError(f"Settings file not found: {args.settings}")
+    return read_settings(args.settings)
+
+
+def render_command(args):
+    # Imported here so --help and argument errors come back at once
+    from render import RenderJob, generate_documents, resolve_workers
+
+    settings = load_command_settings(args)
+
+    # Paths given on the command line take precedence over the settings file
+    template_path = args.template or settings["template_path"]
+    csv_path = args.csv or settings["csv_path"]
+    output_dir = args.output or settings["output_dir"]
+    workers = args.workers if args.workers is not None else settings["workers"]
+    output_mode = args.output_mode or settings["output_mode"]
+    archive = args.archive or settings["archive"]
+    if archive == "none":
+        archive = ""
+    metrics_dir = args.metrics_dir or settings["metrics_dir"]
+    selection = args.rows if args.rows is not None else settings["row_selection"]
+    query = args.query if args.query is not None else settings["source_query"]
+
+    job = RenderJob(
+        template_path,
+        output_dir,
+        settings["filename_prefix"],
+        rich_text_from_settings(settings),
+        settings["font_name"],
+        settings["font_size"],
+        settings["x_percent"],
+        settings["y_percent"],
+        settings["max_chars"],
+        output_mode,
+        settings["merged_filename"],
+        settings["wrap_mode"],
+        settings["line_width"],
+        settings["custom_fonts"],
+        archive,
+        settings["archive_filename"],
+        args.shard_by if args.shard_by is not None else settings["shard_by"]
+    )
+    os.makedirs(output_dir, exist_ok=True)
+
+    metrics = Metrics() if metrics_dir else None
+    # --force renders every row but keeps the manifest, so the next run can skip again
+    manifest = Manifest(output_dir, reuse=not args.force) if settings["incremental"] else None
+    started = time.monotonic()
+    count = generate_documents(
+        job, csv_path, resolve_workers(workers),
+        warn=lambda message: print(f"Warning: {message}", file=sys.stderr),
+        metrics=metrics,
+        manifest=manifest,
+        selection=selection,
+        query=query
+    )
+    elapsed = time.monotonic() - started
+    if metrics is not None:
+        metrics.finish()
+        metrics.write_report(metrics_dir)
+    skipped = manifest.skipped if manifest is not None else 0
+    rendered = count - skipped
+    rate = rendered / elapsed if elapsed > 0 else 0.0
+    print(f"Rendered {rendered} rows in {elapsed:.1f}s ({rate:.1f} rows/s)")
+    if skipped:
+        print(f"{skipped} rows were unchanged and kept their existing PDFs")
+    if rendered:
+        print(f"Page cache: {job.cache_hits} hits, {job.cache_misses} misses")
+    return 0
+
+
+def serve_command(args):
+    import asyncio
+    from render import RenderJob, resolve_workers
+    from service import DEFAULT_HOST, DEFAULT_MAX_PENDING, DEFAULT_PORT, RenderService, serve
+
+    settings = load_command_settings(args)
+    # Each request is one document, so a merged settings file serves plain files
+    output_mode = args.output_mode or settings["output_mode"]
+    if output_mode == "merged":
+        output_mode = "files"
+    metrics_dir = args.metrics_dir or settings["metrics_dir"]
+
+    # Nothing is written, so the job needs no output directory
+    job = RenderJob(
+        args.template or settings["template_path"],
+        ".",
+        settings["filename_prefix"],
+        rich_text_from_settings(settings),
+        settings["font_name"],
+        settings["font_size"],
+        settings["x_percent"],
+        settings["y_percent"],
+        settings["max_chars"],
+        output_mode,
+        settings["merged_filename"],
+        settings["wrap_mode"],
+        settings["line_width"],
+        settings["custom_fonts"],
+    )
+    service = RenderService(
+        job,
+        resolve_workers(args.workers if args.workers is not None else settings["workers"]),
+        args.max_concurrent,
+        args.max_pending if args.max_pending is not None else DEFAULT_MAX_PENDING
+    )
+    try:
+        asyncio.run(serve(
+            service, args.socket, args.host or DEFAULT_HOST, args.port if args.port is not None else DEFAULT_PORT,
+            ready=lambda address: print(f"Serving on {address} with {service.workers} workers", flush=True)
+        ))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if metrics_dir:
+            service.metrics.write_report(metrics_dir)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="csv2pdf", description="Generate PDFs from a template and a CSV file.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render = subparsers.add_parser(
+        "render",
+        help="render PDFs without opening the GUI",
+        description="Render one PDF per CSV row using a settings JSON saved by the GUI. "
+                    "Formatting in text_content is written as <b>bold</b>, <i>italic</i> and <u>underline</u>."
+    )
+    render.add_argument("--settings", default="settings.json", help="settings JSON (default: settings.json)")
+    render.add_argument("--template", help="template PDF, overrides template_path")
+    render.add_argument("--csv", help="input file: CSV, .csv.gz, JSON Lines (.jsonl, .jsonl.gz) or SQLite (.sqlite, .db); overrides csv_path")
+    render.add_argument("--query", help="SQL query giving the rows of a SQLite input; overrides source_query")
+    render.add_argument("--output", help="output directory, overrides output_dir")
+    render.add_argument("--workers", help="worker processes, 0 for one per core; overrides workers")
+    render.add_argument("--output-mode", choices=OUTPUT_MODES, help="one PDF per row, a single merged PDF, or one PDF per row appended to the template's unchanged bytes; overrides output_mode")
+    render.add_argument("--archive", choices=("none",) + ARCHIVE_FORMATS, help="write every PDF into one ZIP or TAR file in the output directory instead of loose files; overrides archive")
+    render.add_argument("--shard-by", help='put the PDFs in subdirectories: "hash" for 256 by a hash of the file name, or a tag for one per value; overrides shard_by')
+    render.add_argument("--rows", help='rows to render, e.g. "51200-51250" or "city=Madrid" (row 1 follows the header); overrides row_selection')
+    render.add_argument("--force", action="store_true", help="render every row, even those whose PDF is up to date")
+    render.add_argument("--metrics-dir", help="write per-stage timings and counters here as JSON and Prometheus text; overrides metrics_dir")
+    render.set_defaults(handler=render_command)
+
+    serve = subparsers.add_parser(
+        "serve",
+        help="render single PDFs on request from a local service",
+        description="Keep the template, text and fonts of a settings JSON loaded in worker processes and render one PDF "
+                    "per request. POST a JSON object of field values to /render to get the PDF back; GET /metrics gives "
+                    "request latencies in Prometheus text format and GET /health tells whether the service is up."
+    )
+    serve.add_argument("--settings", default="settings.json", help="settings JSON (default: settings.json)")
+    serve.add_argument("--template", help="template PDF, overrides template_path")
+    serve.add_argument("--socket", default="", help="listen on this Unix socket, readable only by the current user, instead of TCP")
+    # Defaults live in service.py, which is only imported to serve
+    serve.add_argument("--host", help="TCP address to listen on (default: 127.0.0.1)")
+    serve.add_argument("--port", type=int, help="TCP port to listen on, 0 for any free port (default: 8765)")
+    serve.add_argument("--workers", help="worker processes, 0 for one per core; overrides workers")
+    serve.add_argument("--output-mode", choices=("files", "spliced"), help="whole PDFs, or the template's unchanged bytes plus an update; overrides output_mode")
+    serve.add_argument("--max-concurrent", type=int, default=0, help="requests rendering at once (default: one per worker)")
+    serve.add_argument("--max-pending", type=int, help="requests waiting for a worker before more are refused with 503 (default: 64)")
+    serve.add_argument("--metrics-dir", help="write the request and stage metrics here when the service stops; overrides metrics_dir")
+    serve.set_defaults(handler=serve_command)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        return args.handler(args)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+import json
+import os
+import re
+import sys
+from array import array
+from bisect import bisect_left
+from csvsplit import map_file, read_csv_header, read_csv_range, record_end
+
+
+INDEX_VERSION = 1
+
+# Sidecar files written next to the CSV
+ROWS_SUFFIX = ".csv2pdf-rows"
+VALUES_SUFFIX = ".csv2pdf-values"
+NAMES_SUFFIX = ".csv2pdf-names"
+
+# "51200-51250", "7" or "city=Madrid"
+RANGE_RE = re.compile(r'^(\d+)(?:\s*-\s*(\d+))?$')
+
+
+def _stamp(csv_path):
+    stat = os.stat(csv_path)
+    return {"version": INDEX_VERSION, "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _save(path, write):
+    # Write beside the CSV through a temporary file; an index that cannot be
+    # saved, e.g. in a read-only directory, is simply rebuilt next time
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
+    except OSError:
+        pass
+
+
+class CsvIndex:
+    """Byte offsets of every row of a CSV, saved beside it and rebuilt when the file changes
+
+    Rows are numbered from 1, the first row after the header, counting the
+    rows csv.DictReader would return (blank lines are not rows). Row n spans
+    offsets[n - 1] to offsets[n].
+    """
+
+    def __init__(self, csv_path, save=True):
+        self.csv_path = csv_path
+        self.stamp = _stamp(csv_path)
+        self.headers = None
+        self.offsets = array("Q")
+        self._values = None
+        if not self._load():
+            self._build()
+            if save:
+                _save(csv_path + ROWS_SUFFIX, self._write)
+
+    @property
+    def row_count(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def _load(self):
+        try:
+            with open(self.csv_path + ROWS_SUFFIX, "rb") as f:
+                meta = json.loads(f.readline())
+                if meta.get("stamp") != self.stamp or meta.get("byteorder") != sys.byteorder:
+                    return False
+                self.headers = meta["headers"]
+                self.offsets.frombytes(f.read())
+        except (OSError, ValueError, KeyError):
+            self.offsets = array("Q")
+            return False
+        return True
+
+    def _write(self, f):
+        meta = {"stamp": self.stamp, "byteorder": sys.byteorder, "headers": self.headers}
+        f.write(json.dumps(meta).encode() + b"\n")
+        f.write(self.offsets.tobytes())
+
+    def _build(self):
+        self.headers, pos = read_csv_header(self.csv_path)
+        with open(self.csv_path, "rb") as csv_file:
+            data = map_file(csv_file)
+            size = len(data)
+            while pos < size:
+                end = record_end(data, pos)
+                if data[pos:end].strip(b"\r\n"):
+                    self.offsets.append(pos)
+                pos = end
+        if self.offsets:
+            self.offsets.append(size)
+
+    def spans(self, row_numbers):
+        """Return (start, end, rows) byte spans covering sorted row numbers, joining neighbouring rows"""
+        spans = []
+        for number in row_numbers:
+            start, end = self.offsets[number - 1], self.offsets[number]
+            if spans and spans[-1][1] == start:
+                spans[-1] = (spans[-1][0], end, spans[-1][2] + 1)
+            else:
+                spans.append((start, end, 1))
+        return spans
+
+    def values(self, columns):
+        """Return {column: {value: [row numbers]}} for the given columns
+
+        Value indexes are built with one pass over the file the first time a
+        column is asked for and saved beside the CSV with the row offsets.
+        """
+        if self._values is None:
+            self._values = {}
+            try:
+                with open(self.csv_path + VALUES_SUFFIX, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+                if saved.get("stamp") == self.stamp:
+                    self._values = saved["columns"]
+            except (OSError, ValueError, KeyError):
+                pass
+
+        missing = [column for column in columns if column not in self._values]
+        if missing and self.offsets:
+            built = {column: {} for column in missing}
+            rows = read_csv_range(self.csv_path, self.offsets[0], self.offsets[-1], self.headers)
+            for number, row in enumerate(rows, 1):
+                for column, index in built.items():
+                    index.setdefault(row[column] or "", []).append(number)
+            self._values.update(built)
+            saved = {"stamp": self.stamp, "columns": self._values}
+            _save(self.csv_path + VALUES_SUFFIX, lambda f: f.write(json.dumps(saved).encode()))
+        return {column: self._values.get(column, {}) for column in columns}
+
+
+class SavedRenames:
+    """Rows a filename plan of the whole CSV renamed, saved beside it for later runs
+
+    A plan depends only on the CSV, the filename pattern and shard_by, so it
+    is found again while the file's modification time and size and those
+    settings are unchanged. Selections then look up just their own rows.
+    The stamp is taken when this is created, before the CSV is planned.
+    """
+
+    def __init__(self, csv_path, pattern, shard_by):
+        self.path = csv_path + NAMES_SUFFIX
+        self.stamp = _stamp(csv_path)
+        self.key = {"pattern": pattern, "shard_by": shard_by}
+        self.numbers = array("I")  # Renamed row numbers, ascending
+        self.copies = array("I")  # Copy number of each of them
+        self.example = None
+
+    @property
+    def count(self):
+        return len(self.numbers)
+
+    def load(self):
+        """Read the saved renames; False when none were saved for this version of the CSV and these settings"""
+        try:
+            with open(self.path, "rb") as f:
+                meta = json.loads(f.readline())
+                if (meta.get("stamp") != self.stamp or meta.get("key") != self.key
+                        or meta.get("byteorder") != sys.byteorder or meta.get("itemsize") != self.numbers.itemsize):
+                    return False
+                data = f.read()
+                self.example = meta["example"]
+        except (OSError, ValueError, KeyError):
+            return False
+        self.numbers.frombytes(data[:len(data) // 2])
+        self.copies.frombytes(data[len(data) // 2:])
+        return True
+
+    def save(self, plan):
+        """Save the renames of a FilenamePlan covering every row of the CSV"""
+        numbers = sorted(plan.renames)
+        meta = {"stamp": self.stamp, "key": self.key, "byteorder": sys.byteorder,
+                "itemsize": self.numbers.itemsize, "example": plan.example}
+
+        def write(f):
+            f.write(json.dumps(meta).encode() + b"\n")
+            f.write(array("I", numbers).tobytes())
+            f.write(array("I", (plan.renames[number] for number in numbers)).tobytes())
+        _save(self.path, write)
+
+    def renames(self, row_numbers):
+        """Return {row number: copy number} for the given rows that were renamed"""
+        found = {}
+        for number in row_numbers:
+            position = bisect_left(self.numbers, number)
+            if position < len(self.numbers) and self.numbers[position] == number:
+                found[number] = self.copies[position]
+        return found
+
+
+def parse_selection(selection):
+    """Split a selection such as "1-50, 75, city=Madrid" into row ranges and column conditions"""
+    ranges = []
+    conditions = {}
+    for item in selection.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "=" in item:
+            column, value = item.split("=", 1)
+            conditions[column.strip()] = value.strip()
+            continue
+        match = RANGE_RE.match(item)
+        if match is None:
+            raise ValueError(f"Invalid row selection: {item}")
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid row range: {item}")
+        ranges.append((first, last))
+    return ranges, conditions
+
+
+def select_rows(index, selection):
+    """Return the sorted row numbers matching a selection
+
+    Row numbers and ranges add rows; column=value conditions must all hold.
+    With only conditions every row is a candidate, with only ranges every
+    row in them is selected.
+    """
+    ranges, conditions = parse_selection(selection)
+    for column in conditions:
+        if column not in (index.headers or ()):
+            raise ValueError(f"Column '{column}' not found in CSV headers: {index.headers}")
+
+    selected = None
+    if ranges:
+        selected = set()
+        for first, last in ranges:
+            if first > index.row_count:
+                raise ValueError(f"Row {first} is past the last row ({index.row_count})")
+            selected.update(range(first, min(last, index.row_count) + 1))
+    if conditions:
+        values = index.values(list(conditions))
+        for column, value in conditions.items():
+            matches = set(values[column].get(value, ()))
+            selected = matches if selected is None else selected & matches
+    if selected is None:
+        return list(range(1, index.row_count + 1))
+    return sorted(selected)
+
+
+def row_filter(selection, headers):
+    """Return a test of (row number, row) for a selection, for rows read as a stream
+
+    It selects the same rows select_rows() would, without needing an index.
+    """
+    ranges, conditions = parse_selection(selection)
+    for column in conditions:
+        if column not in (headers or ()):
+            raise ValueError(f"Column '{column}' not found in headers: {headers}")
+
+    def matches(number, row):
+        if ranges and not any(first <= number <= last for first, last in ranges):
+            return False
+        return all((row.get(column) or "") == value for column, value in conditions.items())
+    return matches
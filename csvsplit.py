@@ -0,0 +1,118 @@
+import csv
+import io
+import mmap
+import os
+
+
+BOM = b"\xef\xbb\xbf"
+
+# Bytes read to estimate the length of a row
+SAMPLE_BYTES = 1 << 16
+
+# Smallest byte range handed to a worker
+MIN_RANGE_BYTES = 1 << 12
+
+
+def map_file(csv_file):
+    # mmap refuses empty files, which simply have no rows
+    if os.fstat(csv_file.fileno()).st_size == 0:
+        return b""
+    return mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def record_end(data, pos, quoted=False):
+    """Return the offset just past the first line break at or after pos that is outside quotes
+
+    quoted says whether pos itself is inside a quoted field. A field's
+    quotes, doubled ones included, always come in pairs, so a line break is
+    outside quotes when an even number of them came before it.
+    """
+    while True:
+        newline = data.find(b"\n", pos)
+        if newline < 0:
+            return len(data)
+        if data[pos:newline].count(b'"') % 2:
+            quoted = not quoted
+        if not quoted:
+            return newline + 1
+        pos = newline + 1
+
+
+def read_csv_header(csv_path):
+    """Return the CSV's header fields and the byte offset where its first row starts
+
+    A UTF-8 BOM is skipped as the utf-8-sig codec would. An empty file has
+    no headers (None) and no rows.
+    """
+    with open(csv_path, "rb") as csv_file:
+        data = map_file(csv_file)
+        start = len(BOM) if data[:len(BOM)] == BOM else 0
+        end = record_end(data, start)
+        header = bytes(data[start:end]).decode("utf-8")
+    headers = next(csv.reader(io.StringIO(header, newline="")), None)
+    return headers, end
+
+
+def split_csv(csv_path, data_start, rows_per_range):
+    """Yield (start, end) byte ranges of whole records, each about rows_per_range rows long
+
+    Ranges are found lazily so workers can start on the first ones while the
+    rest of the file is still being scanned. Records must end in \\n or \\r\\n
+    and quotes may only appear around fields, as in RFC 4180.
+    """
+    with open(csv_path, "rb") as csv_file:
+        data = map_file(csv_file)
+        size = len(data)
+
+        # Guess the range length from the rows at the start of the file
+        sample = data[data_start:data_start + SAMPLE_BYTES]
+        row_bytes = len(sample) / max(sample.count(b"\n"), 1)
+        range_bytes = max(int(row_bytes * rows_per_range), MIN_RANGE_BYTES)
+
+        start = data_start
+        while start < size:
+            target = start + range_bytes
+            if target >= size:
+                yield start, size
+                break
+            # start is a record boundary, so the quotes since then tell
+            # whether target falls inside a quoted field
+            quoted = data[start:target].count(b'"') % 2 == 1
+            end = record_end(data, target, quoted)
+            yield start, end
+            start = end
+
+
+class _ByteRange(io.RawIOBase):
+    """Read-only view of data[start:end] as a binary file"""
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.pos = start
+        self.end = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self.end - self.pos)
+        buffer[:count] = self.data[self.pos:self.pos + count]
+        self.pos += count
+        return count
+
+
+# Maps of the files this process has opened: path -> ((mtime, size), map)
+_mapped = {}
+
+
+def read_csv_range(csv_path, start, end, headers):
+    """Return a DictReader over the records in csv_path[start:end] using the given headers"""
+    stat = os.stat(csv_path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _mapped.get(csv_path)
+    if cached is None or cached[0] != version:
+        # Map the file again once it changes, e.g. between runs from the GUI
+        with open(csv_path, "rb") as csv_file:
+            cached = _mapped[csv_path] = (version, map_file(csv_file))
+    text = io.TextIOWrapper(io.BufferedReader(_ByteRange(cached[1], start, end)), encoding="utf-8", newline="")
+    return csv.DictReader(text, fieldnames=headers)
@@ -0,0 +1,164 @@
+import hashlib
+import re
+from string import Formatter
+
+
+# Characters Windows, macOS or Linux refuse in a file name, and control characters
+UNSAFE_RE = re.compile(r'[<>:"/\\|?*\x00-\x1f\x7f]')
+
+# Names Windows reserves for devices, with or without an extension
+RESERVED_NAMES = {"CON", "PRN", "AUX", "NUL"} | {f"{prefix}{digit}" for prefix in ("COM", "LPT") for digit in range(1, 10)}
+
+# Longest file name, in UTF-8 bytes, most file systems accept
+MAX_NAME_BYTES = 255
+
+# shard_by value that spreads files over 256 subdirectories by a hash of their name
+HASH_SHARDS = "hash"
+
+
+def _fit(text, max_bytes):
+    # Cut text to at most max_bytes of UTF-8 without splitting a character
+    return text.encode("utf-8")[:max_bytes].decode("utf-8", "ignore")
+
+
+def sanitize_component(text):
+    """Make text safe as one file or directory name on any common file system"""
+    text = UNSAFE_RE.sub("_", text).strip(" ").rstrip(".")
+    if not text or text in (".", ".."):
+        return "_"
+    if text.split(".")[0].upper() in RESERVED_NAMES:
+        text = "_" + text
+    return _fit(text, MAX_NAME_BYTES)
+
+
+def _hash_shard(name):
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()[:2]
+
+
+def pdf_name(stem, suffix="", extension=".pdf"):
+    """Join stem, suffix and extension, shortening the stem to keep the name within MAX_NAME_BYTES"""
+    stem = _fit(stem, MAX_NAME_BYTES - len((suffix + extension).encode("utf-8")))
+    return sanitize_component(stem + suffix + extension)
+
+
+class FilenamePattern:
+    """Output filename pattern compiled once against the CSV headers"""
+
+    def __init__(self, pattern, headers):
+        # Format filename with tags
+        pattern = pattern.strip()
+        if not pattern:  # Handle empty filename
+            pattern = "document"
+
+        self.parts = []  # (literal, tag, format spec, conversion)
+        for literal, tag, spec, conversion in Formatter().parse(pattern):
+            if tag is not None and tag not in (headers or ()):
+                raise ValueError(f"Tag '{tag}' not found in CSV headers: {headers}")
+            self.parts.append((literal, tag, spec, conversion))
+        self.tags = [tag for literal, tag, spec, conversion in self.parts if tag is not None]
+
+    def format(self, row):
+        """Return the filename for row, safe for the file system and always ending in .pdf"""
+        pieces = []
+        for literal, tag, spec, conversion in self.parts:
+            pieces.append(literal)
+            if tag is not None:
+                value = row[tag]
+                if value is None:  # A row with fewer fields than the header
+                    value = ""
+                if conversion == 'r':
+                    value = repr(value)
+                elif conversion == 'a':
+                    value = ascii(value)
+                elif conversion == 's':
+                    value = str(value)
+                pieces.append(format(value, spec or ''))
+        filename = ''.join(pieces)
+
+        # Handle .pdf extension
+        if filename.lower().endswith('.pdf'):
+            return pdf_name(filename[:-4], extension=filename[-4:])
+        return pdf_name(filename)
+
+
+class FilenamePlan:
+    """Every row's output path, expanded and checked for collisions before rendering
+
+    Each row's base_path() is added in order with add(). A row whose path was taken by an
+    earlier row, compared without regard to case as on Windows and macOS,
+    is renamed "name (2).pdf", "name (3).pdf" and so on. With shard_by set to
+    "hash" files go into 256 subdirectories named after a hash of the file
+    name; set to a tag, into a subdirectory per value of that tag.
+    """
+
+    def __init__(self, pattern, headers, shard_by=""):
+        self.pattern = FilenamePattern(pattern, headers)
+        if shard_by and shard_by != HASH_SHARDS and shard_by not in (headers or ()):
+            raise ValueError(f"Tag '{shard_by}' to shard by not found in CSV headers: {headers}")
+        self.shard_by = shard_by
+        self.tags = self.pattern.tags + ([shard_by] if shard_by and shard_by != HASH_SHARDS else [])
+        self.renames = {}  # row number -> copy number, for rows renamed to avoid a collision
+        self.renamed = 0  # Rows renamed in the whole plan, which renames may only hold some of
+        self.example = None  # The first renamed path
+        self._taken = set()
+        self._next_copy = {}  # Contested path -> first copy number not yet tried
+
+    def __getstate__(self):
+        # Worker processes get the renames of their rows with each task
+        return dict(self.__dict__, renames={}, _taken=set(), _next_copy={})
+
+    def _path(self, row, name):
+        # "/" separates the subdirectory on every platform and inside archives
+        if self.shard_by == HASH_SHARDS:
+            return f"{_hash_shard(name)}/{name}"
+        if self.shard_by:
+            return f"{sanitize_component(row[self.shard_by] or '')}/{name}"
+        return name
+
+    def _copy_path(self, path, copy):
+        # "name (copy).pdf" in the same subdirectory, or in its own one when sharding by hash
+        directory, _, name = path.rpartition("/")
+        name = pdf_name(name[:-4], f" ({copy})", name[-4:])
+        if self.shard_by == HASH_SHARDS:
+            directory = _hash_shard(name)
+        return f"{directory}/{name}" if directory else name
+
+    def base_path(self, row):
+        """Return the path of row before collisions are resolved; worker processes can work these out"""
+        return self._path(row, self.pattern.format(row))
+
+    def add(self, number, path):
+        """Plan the path of row number number, given its base_path()"""
+        key = path.casefold()
+        if key in self._taken:
+            # Copies below the last one handed out are all taken already
+            copy = self._next_copy.get(key, 2)
+            renamed = self._copy_path(path, copy)
+            while renamed.casefold() in self._taken:
+                copy += 1
+                renamed = self._copy_path(path, copy)
+            self._next_copy[key] = copy + 1
+            self.renames[number] = copy
+            self.renamed += 1
+            if self.example is None:
+                self.example = renamed
+            path = renamed
+        self._taken.add(path.casefold())
+
+    def add_untagged(self, numbers, row_count):
+        """Plan rows numbers of row_count for a pattern without tags, where row n is simply copy n of the one name"""
+        self.renames = {number: number for number in numbers if number > 1}
+        self.renamed = max(row_count - 1, 0)
+        if self.renamed:
+            self.example = self._copy_path(self.base_path({}), 2)
+
+    def finish(self):
+        # Drop the names seen; only the renames are needed to render
+        self._taken = set()
+        self._next_copy = {}
+
+    def path(self, number, row):
+        """Return the planned path of a row, relative to the output directory"""
+        path = self.base_path(row)
+        copy = self.renames.get(number)
+        return self._copy_path(path, copy) if copy else path
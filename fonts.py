@@ -0,0 +1,79 @@
+import hashlib
+import os
+
+
+# Built-in PDF fonts with style variants: (regular, bold, italic, bold italic)
+BASE_FAMILIES = {
+    "Helvetica": ("Helvetica", "Helvetica-Bold", "Helvetica-Oblique", "Helvetica-BoldOblique"),
+    "Times-Roman": ("Times-Roman", "Times-Bold", "Times-Italic", "Times-BoldItalic"),
+    "Courier": ("Courier", "Courier-Bold", "Courier-Oblique", "Courier-BoldOblique"),
+}
+
+# Keys of a custom family's font files, in the order of a family tuple
+STYLES = ("regular", "bold", "italic", "bold_italic")
+
+# Fonts registered in this process: (path, mtime, size) -> registered name
+_registered = {}
+
+
+def register_ttf(path):
+    """Parse and register a TrueType font once per process and return its registered name
+
+    A font file that changes on disk is registered again under a new name,
+    so measurements cached for the old file are never reused. reportlab
+    embeds only the glyphs each document uses.
+    """
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFError, TTFont
+    try:
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        name = _registered.get(key)
+        if name is None:
+            stem = os.path.splitext(os.path.basename(path))[0]
+            name = f"{stem}-{hashlib.sha1(repr(key).encode()).hexdigest()[:8]}"
+            pdfmetrics.registerFont(TTFont(name, path))
+            _registered[key] = name
+    except (OSError, TTFError) as e:
+        raise ValueError(f"Cannot load font {path}: {e}")
+    return name
+
+
+def font_family(font_name, font_files=None):
+    """Return the (regular, bold, italic, bold italic) font names for a family
+
+    font_files maps STYLES to TrueType files; styles without a file use the
+    regular one. Unknown built-in names fall back to Courier.
+    """
+    if font_files:
+        regular = font_files.get("regular")
+        if not regular:
+            raise ValueError(f"Font family '{font_name}' has no regular font file")
+        return tuple(register_ttf(font_files.get(style) or regular) for style in STYLES)
+    return BASE_FAMILIES.get(font_name, BASE_FAMILIES["Courier"])
+
+
+def guess_styles(paths):
+    """Sort TrueType files into a family's styles by their file names, e.g. Corporate-BoldItalic.ttf"""
+    font_files = {}
+    for path in paths:
+        name = os.path.basename(path).lower()
+        italic = "italic" in name or "oblique" in name
+        if "bold" in name:
+            style = "bold_italic" if italic else "bold"
+        else:
+            style = "italic" if italic else "regular"
+        font_files.setdefault(style, path)
+    if "regular" not in font_files and font_files:
+        # A lone bold or italic file still makes a usable family
+        font_files["regular"] = next(iter(font_files.values()))
+    return font_files
+
+
+def family_name(font_files):
+    """Name a family after its regular file, e.g. Corporate-Regular.ttf -> Corporate"""
+    stem = os.path.splitext(os.path.basename(font_files["regular"]))[0]
+    for suffix in ("-Regular", "_Regular", " Regular", "-Roman", "-Book"):
+        if stem.endswith(suffix):
+            return stem[:-len(suffix)]
+    return stem
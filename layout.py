@@ -0,0 +1,154 @@
+import re
+from bisect import bisect_right
+
+
+# Words are runs of non-space characters; every whitespace character is its own token
+TOKEN_RE = re.compile(r'\S+|\s')
+
+# "chars" wraps at a character count, "width" at a width in points
+WRAP_MODES = ("chars", "width")
+
+
+class GlyphWidths:
+    """Advance widths of one font at one size, looked up in pdfmetrics once per character"""
+
+    def __init__(self, font_name, font_size):
+        from reportlab.pdfbase import pdfmetrics
+        self.font_name = font_name
+        self.font_size = font_size
+        self._string_width = pdfmetrics.stringWidth
+        self._widths = {}
+
+    def measure(self, text):
+        widths = self._widths
+        total = 0.0
+        for char in text:
+            width = widths.get(char)
+            if width is None:
+                width = widths[char] = self._string_width(char, self.font_name, self.font_size)
+            total += width
+        return total
+
+
+_glyph_widths = {}
+
+
+def glyph_widths(font_name, font_size):
+    """Return the shared GlyphWidths table for a font and size"""
+    key = (font_name, font_size)
+    table = _glyph_widths.get(key)
+    if table is None:
+        table = _glyph_widths[key] = GlyphWidths(font_name, font_size)
+    return table
+
+
+class StyledText:
+    """A row's formatted runs joined into one text, with a sorted index of style starts"""
+
+    def __init__(self, runs):
+        self.starts = []
+        self.ends = []
+        self.formats = []
+        parts = []
+        pos = 0
+        for text, formats in runs:
+            if not text:
+                continue
+            if self.formats and self.formats[-1] == formats:
+                self.ends[-1] += len(text)
+            else:
+                self.starts.append(pos)
+                self.ends.append(pos + len(text))
+                self.formats.append(formats)
+            parts.append(text)
+            pos += len(text)
+        self.text = ''.join(parts)
+
+    def font_ranges(self, font_for):
+        """Return (start, end, font name) for each run, using font_for(formats)"""
+        return [(start, end, font_for(formats)) for start, end, formats in zip(self.starts, self.ends, self.formats)]
+
+    def segments(self, start, end):
+        """Split text[start:end] where the style changes into (text, formats) pieces"""
+        segments = []
+        index = max(bisect_right(self.starts, start) - 1, 0)
+        while start < end and index < len(self.starts):
+            stop = min(end, self.ends[index])
+            if stop > start:
+                segments.append((self.text[start:stop], self.formats[index]))
+                start = stop
+            index += 1
+        return segments
+
+
+def width_measure(text, font_ranges, font_size):
+    """Build a measure for wrap_spans that sizes text in points
+
+    font_ranges is a sorted list of (start, end, font_name) covering text, so
+    words that change style part way are measured with each part's font.
+    """
+    starts = [start for start, end, font_name in font_ranges]
+    tables = [glyph_widths(font_name, font_size) for start, end, font_name in font_ranges]
+
+    def measure(start, end):
+        index = max(bisect_right(starts, start) - 1, 0)
+        total = 0.0
+        while start < end and index < len(font_ranges):
+            stop = min(end, font_ranges[index][1])
+            total += tables[index].measure(text[start:stop])
+            start = stop
+            index += 1
+        return total
+
+    return measure
+
+
+def _count_chars(start, end):
+    return end - start
+
+
+def wrap_spans(text, limit, measure=_count_chars):
+    """Wrap text and return each line as a (start, end) slice of text
+
+    measure(start, end) gives the size of text[start:end] in the same unit as
+    limit; by default the number of characters.
+    """
+    spans = []
+    start = end = None  # The current line is text[start:end]; start is None while it is empty
+    size = 0
+
+    for match in TOKEN_RE.finditer(text):
+        word = match.group()
+        word_start, word_end = match.span()
+
+        # Handle newlines explicitly
+        if word == '\n':
+            if start is not None:
+                spans.append((start, end))
+                start = None
+            spans.append((word_end, word_end))
+            continue
+
+        # Preserve all whitespace at start of line
+        if start is None and word.isspace():
+            start, end, size = word_start, word_end, measure(word_start, word_end)
+            continue
+
+        # Check if adding word would exceed the limit
+        word_size = measure(word_start, word_end)
+        if start is None:
+            # A word longer than a whole line still gets a line of its own
+            start, end, size = word_start, word_end, word_size
+        elif size + word_size <= limit:
+            end = word_end
+            size += word_size
+        else:
+            spans.append((start, end))
+            if word.isspace():
+                start = None
+            else:
+                start, end, size = word_start, word_end, word_size
+
+    if start is not None:
+        spans.append((start, end))
+    return spans
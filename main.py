@@ -1,444 +1,156 @@
-import os
-import csv
-import json
-from tkinter import Tk, filedialog, messagebox, StringVar, Label, Entry, Button, OptionMenu, Frame, Scrollbar, Text, font
-from tkinter.ttk import Button as TtkButton, Style
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from PyPDF2 import PdfReader, PdfWriter
-from io import BytesIO
+import sys
+import queue
+import threading
+import time
+from fonts import BASE_FAMILIES, family_name, guess_styles
+from manifest import Manifest
+from metrics import Metrics
+from richtext import FORMAT_TAGS, RichText
+from settings import SettingsWriter, load_settings
+from sources import open_source
+
+
+TEXT_INPUT_HELP = "Type your text here. Use {tags} for CSV values. Tags are case-sensitive, e.g. {name} and are defined as the CSV column headers."
+
+# Quiet time after the last change before settings are saved
+SETTINGS_SAVE_DELAY_MS = 500
+
+# Quiet time after the last change before the preview is redrawn
+PREVIEW_DELAY_MS = 150
+
+# How often the preview checks whether its row index is ready
+PREVIEW_INDEX_POLL_MS = 200
+
+# Preview pixels per PDF point
+PREVIEW_SCALE = 0.75
+
+
+OUTPUT_MODE_LABELS = {
+    "files": "One PDF per row",
+    "merged": "Single merged PDF",
+    "spliced": "One PDF per row, appended to the template",
+}
+
+
+ARCHIVE_LABELS = {
+    "": "Loose files",
+    "zip": "ZIP archive",
+    "tar": "TAR archive",
+}
+
+
+WRAP_MODE_LABELS = {
+    "chars": "Character count",
+    "width": "Line width",
+}
+
+
+def mode_from_label(labels, label):
+    for mode, mode_label in labels.items():
+        if mode_label == label:
+            return mode
+    return next(iter(labels))
 
 
 def select_file(file_var, file_type):
-    filetypes = [("PDF files", "*.pdf")] if file_type == "PDF" else [("CSV files", "*.csv")]
+    from tkinter import filedialog
+    if file_type == "PDF":
+        filetypes = [("PDF files", "*.pdf")]
+    else:
+        filetypes = [("Data files", "*.csv *.csv.gz *.jsonl *.ndjson *.jsonl.gz *.sqlite *.sqlite3 *.db"), ("All files", "*")]
     filepath = filedialog.askopenfilename(filetypes=filetypes)
     file_var.set(filepath)
 
 
+def select_font_files():
+    from tkinter import filedialog
+    return filedialog.askopenfilenames(title="Select the TrueType files of one font family", filetypes=[("TrueType fonts", "*.ttf")])
+
+
 def select_directory(directory_var):
+    from tkinter import filedialog
     directory = filedialog.askdirectory()
     directory_var.set(directory)
 
 
-def wrap_text(text, max_chars):
-    # Split text into words while preserving spaces
-    words = []
-    current_word = ''
-    for char in text:
-        if char.isspace():
-            if current_word:
-                words.append(current_word)
-                current_word = ''
-            words.append(char)
-        else:
-            current_word += char
-    if current_word:
-        words.append(current_word)
-
-    lines = []
-    current_line = ''
-    
-    for word in words:
-        # Handle newlines explicitly
-        if word == '\n':
-            if current_line:
-                lines.append(current_line)
-                current_line = ''
-            lines.append('')
-            continue
-            
-        # Preserve all whitespace at start of line
-        if not current_line and word.isspace():
-            current_line = word
-            continue
-            
-        # Check if adding word would exceed max_chars
-        test_line = current_line + word if current_line else word
-        if len(test_line) <= max_chars:
-            current_line = test_line
-        else:
-            if current_line:
-                lines.append(current_line)
-            current_line = word if not word.isspace() else ''
-
-    if current_line:
-        lines.append(current_line)
-        
-    return lines
-
-
-def process_escape_sequences(text):
-    # Process \n first to handle line breaks
-    text = text.replace('\\n', '\n')
-    
-    # Process \t by adding 4 spaces for each tab
-    lines = text.split('\n')
-    processed_lines = []
-    for line in lines:
-        # Process tabs at the beginning of the line first
-        while line.startswith('\\t'):
-            line = '    ' + line[2:]  # Replace \t with 4 spaces
-            
-        # Then process any remaining tabs in the line
-        while '\\t' in line:
-            tab_pos = line.find('\\t')
-            line = line[:tab_pos] + '    ' + line[tab_pos+2:]
-        processed_lines.append(line)
-    
-    # Join lines back together
-    text = '\n'.join(processed_lines)
-    
-    # Process other escape sequences
-    text = text.replace('\\r', '\r')
+def snapshot_text_widget(text_widget):
+    """Capture the editor's text and formatting tags once, as a RichText"""
+    text = text_widget.get("1.0", "end-1c")
+
+    # Character offset at which each line of the widget starts
+    line_offsets = [0]
+    for line in text.split('\n'):
+        line_offsets.append(line_offsets[-1] + len(line) + 1)
+
+    def to_offset(index):
+        line, column = (int(part) for part in str(index).split('.'))
+        return line_offsets[min(line, len(line_offsets)) - 1] + column
+
+    format_ranges = {}
+    for tag in FORMAT_TAGS:
+        ranges = text_widget.tag_ranges(tag)
+        format_ranges[tag] = [
+            (to_offset(ranges[i]), to_offset(ranges[i + 1]))
+            for i in range(0, len(ranges), 2)
+        ]
+    return RichText(text, format_ranges)
+
+
+def format_progress(done, total, elapsed):
+    # total is None for inputs that are not counted before rendering
+    rate = done / elapsed if elapsed > 0 else 0.0
+    text = f"Rows: {done}/{total}   {rate:.1f} rows/s" if total is not None else f"Rows: {done}   {rate:.1f} rows/s"
+    if rate > 0 and total is not None and total > done:
+        remaining = int((total - done) / rate)
+        text += f"   ETA {remaining // 60}m {remaining % 60:02d}s"
     return text
 
 
-def generate_pdfs(root_window, template_path, csv_path, output_dir, filename_prefix, custom_text, font_name, font_size, x_percent, y_percent, max_chars, text_widget):
+def generate_pdfs(job, csv_path, workers, messages, cancel_event, metrics_dir="", incremental=True, selection="", query=""):
+    """Run a batch off the Tk thread, reporting to the GUI through the messages queue"""
+    from render import count_rows, generate_documents
     try:
-        if not template_path or not csv_path or not output_dir or not custom_text:
-            raise ValueError("All fields are required!")
-
-        x = float(x_percent) / 100
-        y = float(y_percent) / 100
-        font_size = int(font_size)
-        max_chars = int(max_chars)
-
-        pdf_reader = PdfReader(template_path)
-
-        with open(csv_path, mode="r", encoding='utf-8-sig') as csvfile:  # utf-8-sig handles BOM character
-            reader = csv.DictReader(csvfile)
-            headers = reader.fieldnames
-
-            for row in reader:
-                try:
-                    # Get original text
-                    original_text = text_widget.get("1.0", "end-1c")
-                    
-                    # Replace tags first
-                    text_with_tags = original_text
-                    for key, value in row.items():
-                        placeholder = "{" + key + "}"
-                        text_with_tags = text_with_tags.replace(placeholder, str(value))
-                    
-                    # Then process escape sequences
-                    processed_text = process_escape_sequences(text_with_tags)
-                    
-                    # Create a temporary text widget to handle formatting
-                    temp_widget = Text(root_window)
-                    temp_widget.insert("1.0", processed_text)
-                    
-                    # Copy formatting from original widget
-                    for tag in ["bold", "italic", "underline"]:
-                        ranges = text_widget.tag_ranges(tag)
-                        for i in range(0, len(ranges), 2):
-                            start = ranges[i]
-                            end = ranges[i+1]
-                            temp_widget.tag_add(tag, start, end)
-                    
-                    # Get text with formatting by segments
-                    formatted_text = []
-                    start = "1.0"
-                    line_start = True  # Track if we're at the start of a line
-                    
-                    while True:
-                        if temp_widget.compare(start, ">=", "end-1c"):
-                            break
-                            
-                        # Get current formatting
-                        formats = []
-                        for tag in ["bold", "italic", "underline"]:
-                            if tag in temp_widget.tag_names(start):
-                                formats.append(tag)
-                        
-                        # Get current character
-                        char = temp_widget.get(start)
-                        
-                        # Handle line start indentation
-                        if line_start and char.isspace():
-                            # Find all spaces at start of line
-                            next_pos = start
-                            spaces = ""
-                            while True:
-                                if temp_widget.compare(next_pos, ">=", "end-1c"):
-                                    break
-                                char = temp_widget.get(next_pos)
-                                if not char.isspace():
-                                    break
-                                spaces += char
-                                next_pos = temp_widget.index(f"{next_pos}+1c")
-                            
-                            if spaces:
-                                formatted_text.append((spaces, formats))
-                                start = next_pos
-                                line_start = False
-                                continue
-                        
-                        # Find next format change or space
-                        next_pos = start
-                        while True:
-                            if temp_widget.compare(next_pos, ">=", "end-1c"):
-                                break
-                            
-                            next_char = temp_widget.get(next_pos)
-                            next_formats = []
-                            for tag in ["bold", "italic", "underline"]:
-                                if tag in temp_widget.tag_names(next_pos):
-                                    next_formats.append(tag)
-                                    
-                            # Break if formatting changes or we hit a space
-                            if next_formats != formats or next_char.isspace():
-                                break
-                                
-                            next_pos = temp_widget.index(f"{next_pos}+1c")
-                        
-                        # Get text segment
-                        text = temp_widget.get(start, next_pos)
-                        if text:
-                            # Add segment with its formatting
-                            formatted_text.append((text, formats))
-                            
-                        # If we stopped at a space, add it as a separate segment
-                        if temp_widget.compare(next_pos, "<", "end-1c"):
-                            space_char = temp_widget.get(next_pos)
-                            if space_char.isspace():
-                                # Add space as a separate segment without formatting
-                                formatted_text.append((space_char, []))
-                                next_pos = temp_widget.index(f"{next_pos}+1c")
-                                # Check if this is a newline
-                                if space_char == '\n':
-                                    line_start = True
-                            
-                        start = next_pos
-                        
-                    # Clean up temporary widget
-                    temp_widget.destroy()
-                    
-                    # Process text segments
-                    processed_text = []
-                    for text, formats in formatted_text:
-                        processed_text.append((text, formats))
-                    
-                    # Setup PDF
-                    # Format filename with tags
-                    filename = filename_prefix.strip()
-                    if not filename:  # Handle empty filename
-                        filename = "document"
-                    
-                    # Replace tags in filename
-                    try:
-                        # First check if all tags exist in headers
-                        import re
-                        tags = re.findall(r'\{([^}]+)\}', filename)
-                        for tag in tags:
-                            if tag not in row:
-                                raise KeyError(tag)
-                        # Then do the replacement
-                        filename = filename.format(**row)
-                    except KeyError as e:
-                        raise ValueError(f"Tag '{e.args[0]}' not found in CSV headers: {headers}")
-                    
-                    # Handle .pdf extension
-                    if not filename.lower().endswith('.pdf'):
-                        filename += '.pdf'
-                    
-                    output_pdf_path = os.path.join(output_dir, filename)
-                    
-                    packet = BytesIO()
-                    c = canvas.Canvas(packet, pagesize=letter)
-                    
-                    # Set up fonts - use reportlab's built-in fonts
-                    if font_name == "Helvetica":
-                        base_font = "Helvetica"
-                        bold_font = "Helvetica-Bold"
-                        italic_font = "Helvetica-Oblique"
-                        bold_italic_font = "Helvetica-BoldOblique"
-                    elif font_name == "Times-Roman":
-                        base_font = "Times-Roman"
-                        bold_font = "Times-Bold"
-                        italic_font = "Times-Italic"
-                        bold_italic_font = "Times-BoldItalic"
-                    else:  # Courier
-                        base_font = "Courier"
-                        bold_font = "Courier-Bold"
-                        italic_font = "Courier-Oblique"
-                        bold_italic_font = "Courier-BoldOblique"
-                    
-                    c.setFont(base_font, font_size)
-                    
-                    # Calculate position
-                    line_height = font_size * 1.2
-                    y_start = y * letter[1]
-                    y_pos = letter[1] - y_start
-                    
-                    # First, combine all text while preserving formatting
-                    combined_text = ""
-                    format_ranges = []  # List of (start, end, formats) tuples
-                    current_pos = 0
-                    
-                    for text, formats in processed_text:
-                        if text:
-                            start = current_pos
-                            combined_text += text
-                            end = current_pos + len(text)
-                            if formats:  # Only store if there's formatting
-                                format_ranges.append((start, end, formats))
-                            current_pos = end
-                    
-                    # Wrap text according to max_chars
-                    wrapped_lines = wrap_text(combined_text, max_chars)
-                    
-                    # Draw text line by line
-                    x_offset = x * letter[0]
-                    
-                    for line in wrapped_lines:
-                        if not line.strip():  # Handle empty lines
-                            y_pos -= line_height
-                            continue
-                            
-                        x_pos = x_offset
-                        current_pos = combined_text.find(line)
-                        
-                        # Split line into segments based on formatting
-                        segments = []
-                        current_segment_start = 0
-                        current_formats = []
-                        
-                        for i in range(len(line)):
-                            pos_in_text = current_pos + i
-                            new_formats = []
-                            
-                            # Find all formats that apply to this position
-                            for start, end, formats in format_ranges:
-                                if start <= pos_in_text < end:
-                                    new_formats.extend(formats)
-                            
-                            # If formats changed, end current segment and start new one
-                            if new_formats != current_formats:
-                                if i > current_segment_start:
-                                    segments.append((
-                                        line[current_segment_start:i],
-                                        current_formats
-                                    ))
-                                current_segment_start = i
-                                current_formats = new_formats
-                        
-                        # Add final segment
-                        if current_segment_start < len(line):
-                            segments.append((
-                                line[current_segment_start:],
-                                current_formats
-                            ))
-                        
-                        # Draw segments
-                        for i, (segment, formats) in enumerate(segments):
-                            # Apply font formatting
-                            if 'italic' in formats:
-                                current_font = italic_font
-                                if 'bold' in formats:
-                                    current_font = bold_italic_font
-                            elif 'bold' in formats:
-                                current_font = bold_font
-                            else:
-                                current_font = base_font
-                            
-                            c.setFont(current_font, font_size)
-                            
-                            # Draw text segment
-                            c.drawString(x_pos, y_pos, segment)
-                            
-                            # Add underline if needed
-                            if 'underline' in formats:
-                                width = c.stringWidth(segment, current_font, font_size)
-                                y_underline = y_pos - 1.5
-                                c.setLineWidth(0.5)
-                                c.line(x_pos, y_underline, x_pos + width, y_underline)
-                            
-                            x_pos += c.stringWidth(segment, current_font, font_size)
-                        
-                        y_pos -= line_height
-                    
-
-                    c.save()
-                    packet.seek(0)
-
-                    # Create output PDF
-                    output_pdf = PdfWriter()
-                    # Create a fresh copy of the template page
-                    template_page = PdfReader(template_path).pages[0]
-                    
-                    # Create overlay
-                    overlay = PdfReader(packet)
-                    template_page.merge_page(overlay.pages[0])
-                    
-                    # Add merged page to output
-                    output_pdf.add_page(template_page)
-
-                    # Write the output file
-                    with open(output_pdf_path, "wb") as out_file:
-                        output_pdf.write(out_file)
-                except KeyError as e:
-                    raise ValueError(f"Tag '{e.args[0]}' not found in CSV headers: {headers}")
-
-        messagebox.showinfo("Success", "PDFs generated successfully!")
+        messages.put(("total", count_rows(csv_path, selection, query)))
+        metrics = Metrics() if metrics_dir else None
+        manifest = Manifest(job.output_dir) if incremental else None
+        count = generate_documents(
+            job, csv_path, workers,
+            progress=lambda done: messages.put(("progress", done)),
+            cancel_event=cancel_event,
+            warn=lambda message: messages.put(("warning", message)),
+            metrics=metrics,
+            manifest=manifest,
+            selection=selection,
+            query=query
+        )
+        if metrics is not None:
+            metrics.finish()
+            metrics.write_report(metrics_dir)
+        if manifest is not None and manifest.skipped:
+            messages.put(("skipped", manifest.skipped))
+        messages.put(("cache", (job.cache_hits, job.cache_misses)))
+        messages.put(("done", count))
     except Exception as e:
-        messagebox.showerror("Error", str(e))
-
+        messages.put(("error", str(e)))
 
-def save_settings(settings):
-    """Save settings to JSON file"""
-    settings_file = "settings.json"
-    try:
-        with open(settings_file, 'w') as f:
-            json.dump(settings, f, indent=4)
-    except Exception as e:
-        print(f"Error saving settings: {e}")
-
-def load_settings():
-    """Load settings from JSON file"""
-    settings_file = "settings.json"
-    default_settings = {
-        "font_name": "Helvetica",
-        "font_size": "12",
-        "x_percent": "10",
-        "y_percent": "20",
-        "max_chars": "80",
-        "filename_prefix": "emprius_{name}.pdf",
-        "template_path": "",
-        "csv_path": "",
-        "output_dir": "",
-        "text_content": ""
-    }
-    
-    try:
-        if os.path.exists(settings_file):
-            with open(settings_file, 'r') as f:
-                settings = json.load(f)
-                # Update with any missing default settings
-                for key, value in default_settings.items():
-                    if key not in settings:
-                        settings[key] = value
-                return settings
-    except Exception as e:
-        print(f"Error loading settings: {e}")
-    
-    return default_settings
 
-def update_csv_headers(csv_path_var, headers_var):
+def update_csv_headers(csv_path_var, headers_var, query=""):
     try:
         csv_path = csv_path_var.get()
         if not csv_path:
             raise ValueError("Please select a CSV file first.")
-        with open(csv_path, mode="r", encoding='utf-8-sig') as csvfile:  # utf-8-sig handles BOM character
-            reader = csv.DictReader(csvfile)
-            headers = reader.fieldnames
-            headers_var.set(f"Available tags: {', '.join(headers)}")
+        headers = open_source(csv_path, query).headers or []
+        headers_var.set(f"Available tags: {', '.join(headers)}")
     except Exception as e:
         headers_var.set(f"Error: {str(e)}")
 
 
 def main():
+    # tkinter is only imported here so the headless render command never loads it
+    from tkinter import Tk, Toplevel, messagebox, StringVar, Label, Entry, Button, OptionMenu, Frame, Scrollbar, Text, Canvas, Spinbox, font
+    from tkinter.ttk import Button as TtkButton, Style
+    from preview import PreviewLayout, PreviewRows, draw_preview
+
     root = Tk()
     root.title("CSV2PDF")
     
@@ -451,6 +163,7 @@ def main():
 
     template_var = StringVar(value=settings["template_path"])
     csv_var = StringVar(value=settings["csv_path"])
+    query_var = StringVar(value=settings["source_query"])
     output_dir_var = StringVar(value=settings["output_dir"])
     filename_prefix_var = StringVar(value=settings["filename_prefix"])
     font_var = StringVar(value=settings["font_name"])
@@ -458,12 +171,29 @@ def main():
     x_percent_var = StringVar(value=settings["x_percent"])
     y_percent_var = StringVar(value=settings["y_percent"])
     max_chars_var = StringVar(value=settings["max_chars"])
-
-    # Function to save current settings
-    def save_current_settings(*args):
-        current_settings = {
+    wrap_mode_var = StringVar(value=WRAP_MODE_LABELS.get(settings["wrap_mode"], WRAP_MODE_LABELS["chars"]))
+    line_width_var = StringVar(value=settings["line_width"])
+    workers_var = StringVar(value=settings["workers"])
+    output_mode_var = StringVar(value=OUTPUT_MODE_LABELS.get(settings["output_mode"], OUTPUT_MODE_LABELS["files"]))
+    merged_filename_var = StringVar(value=settings["merged_filename"])
+    archive_var = StringVar(value=ARCHIVE_LABELS.get(settings["archive"], ARCHIVE_LABELS[""]))
+    shard_by_var = StringVar(value=settings["shard_by"])
+    row_selection_var = StringVar(value=settings["row_selection"])
+
+    settings_writer = SettingsWriter()
+    pending_save = {}
+
+    def collect_settings():
+        # Start from the loaded settings so keys without a field, such as
+        # metrics_dir, survive
+        current_settings = dict(settings)
+        rich_text = snapshot_text_widget(text_widget)
+        if rich_text.text == TEXT_INPUT_HELP:
+            rich_text = RichText("")
+        current_settings.update({
             "template_path": template_var.get(),
             "csv_path": csv_var.get(),
+            "source_query": query_var.get(),
             "output_dir": output_dir_var.get(),
             "filename_prefix": filename_prefix_var.get(),
             "font_name": font_var.get(),
@@ -471,13 +201,118 @@ def main():
             "x_percent": x_percent_var.get(),
             "y_percent": y_percent_var.get(),
             "max_chars": max_chars_var.get(),
-            "text_content": text_widget.get("1.0", "end-1c") if text_widget.get("1.0", "end-1c") != "Type your text here..." else ""
-        }
-        save_settings(current_settings)
+            "wrap_mode": mode_from_label(WRAP_MODE_LABELS, wrap_mode_var.get()),
+            "line_width": line_width_var.get(),
+            "workers": workers_var.get(),
+            "output_mode": mode_from_label(OUTPUT_MODE_LABELS, output_mode_var.get()),
+            "merged_filename": merged_filename_var.get(),
+            "archive": mode_from_label(ARCHIVE_LABELS, archive_var.get()),
+            "shard_by": shard_by_var.get(),
+            "row_selection": row_selection_var.get(),
+            "text_content": rich_text.text,
+            "text_format_ranges": {tag: rich_text.ranges(tag) for tag in FORMAT_TAGS}
+        })
+        return current_settings
+
+    def write_settings():
+        pending_save.clear()
+        settings_writer.save(collect_settings())
+
+    def build_job(output_dir):
+        from render import RenderJob
+        # Capture everything from the widgets here; the worker never touches Tk
+        return RenderJob(
+            template_var.get(),
+            output_dir,
+            filename_prefix_var.get(),
+            snapshot_text_widget(text_widget),
+            font_var.get(),
+            font_size_var.get(),
+            x_percent_var.get(),
+            y_percent_var.get(),
+            max_chars_var.get(),
+            mode_from_label(OUTPUT_MODE_LABELS, output_mode_var.get()),
+            merged_filename_var.get(),
+            mode_from_label(WRAP_MODE_LABELS, wrap_mode_var.get()),
+            line_width_var.get(),
+            settings["custom_fonts"],
+            mode_from_label(ARCHIVE_LABELS, archive_var.get()),
+            settings["archive_filename"],
+            shard_by_var.get().strip()
+        )
+
+    # Live preview of one row; paragraphs that did not change keep their layout
+    preview_state = {}
+    preview_layout = PreviewLayout()
+    preview_rows = PreviewRows()
+
+    def refresh_preview():
+        preview_state.pop("after_id", None)
+        if "window" not in preview_state:
+            return
+        try:
+            # The preview writes nothing, so it does not need an output directory
+            job = build_job(output_dir_var.get() or ".")
+            found = preview_rows.row(csv_var.get(), int(preview_state["row_var"].get()), query_var.get())
+            if found is None:
+                preview_state["status_var"].set("Indexing rows...")
+                preview_state["after_id"] = root.after(PREVIEW_INDEX_POLL_MS, refresh_preview)
+                return
+            headers, row = found
+            runs = job.rich_text.compile(headers).runs(row)
+            draw_preview(preview_state["canvas"], job, preview_layout.lines(job, runs), PREVIEW_SCALE)
+            preview_state["status_var"].set("")
+        except Exception as e:
+            preview_state["status_var"].set(f"Error: {e}")
+
+    def schedule_preview(*args):
+        if "window" not in preview_state:
+            return
+        if "after_id" in preview_state:
+            root.after_cancel(preview_state["after_id"])
+        preview_state["after_id"] = root.after(PREVIEW_DELAY_MS, refresh_preview)
+
+    def open_preview():
+        if "window" in preview_state:
+            preview_state["window"].lift()
+            return
+        window = Toplevel(root)
+        window.title("Preview")
+        row_var = StringVar(value="1")
+        status_var = StringVar()
+
+        controls = Frame(window)
+        controls.pack(fill='x', padx=8, pady=4)
+        Label(controls, text="Row:").pack(side='left')
+        Spinbox(controls, from_=1, to=10**9, textvariable=row_var, width=8).pack(side='left')
+        Label(controls, textvariable=status_var, wraplength=400, justify="left").pack(side='left', padx=8)
+        canvas = Canvas(window, background="gray85", highlightthickness=0)
+        canvas.pack(padx=8, pady=8)
+
+        def close_preview():
+            if "after_id" in preview_state:
+                root.after_cancel(preview_state["after_id"])
+            preview_state.clear()
+            window.destroy()
+
+        window.protocol("WM_DELETE_WINDOW", close_preview)
+        preview_state.update(window=window, canvas=canvas, row_var=row_var, status_var=status_var)
+        row_var.trace_add("write", schedule_preview)
+        refresh_preview()
+
+    # Function to save current settings; bursts of changes, such as typing,
+    # are saved once they pause, and the file is written off the Tk thread
+    def save_current_settings(*args):
+        if "after_id" in pending_save:
+            root.after_cancel(pending_save["after_id"])
+        pending_save["after_id"] = root.after(SETTINGS_SAVE_DELAY_MS, write_settings)
+        schedule_preview()
 
     # Track changes to save settings
     template_var.trace_add("write", save_current_settings)
     csv_var.trace_add("write", save_current_settings)
+    query_var.trace_add("write", save_current_settings)
+    query_var.trace_add("write", schedule_preview)
     output_dir_var.trace_add("write", save_current_settings)
     filename_prefix_var.trace_add("write", save_current_settings)
     font_var.trace_add("write", save_current_settings)
@@ -485,42 +320,63 @@ def main():
     x_percent_var.trace_add("write", save_current_settings)
     y_percent_var.trace_add("write", save_current_settings)
     max_chars_var.trace_add("write", save_current_settings)
+    wrap_mode_var.trace_add("write", save_current_settings)
+    line_width_var.trace_add("write", save_current_settings)
+    workers_var.trace_add("write", save_current_settings)
+    output_mode_var.trace_add("write", save_current_settings)
+    merged_filename_var.trace_add("write", save_current_settings)
+    archive_var.trace_add("write", save_current_settings)
+    shard_by_var.trace_add("write", save_current_settings)
+    row_selection_var.trace_add("write", save_current_settings)
 
     # Save settings when window is closed
     def on_closing():
-        save_current_settings()
+        if "after_id" in pending_save:
+            root.after_cancel(pending_save.pop("after_id"))
+        settings_writer.save(collect_settings())
+        settings_writer.flush()
+        # Let a running batch stop after its current row and close its
+        # output, so no half-written merged PDF or archive is left behind
+        if run_state.get("cancel_event") is not None:
+            run_state["cancel_event"].set()
+            root.withdraw()
+            run_state["thread"].join()
         root.destroy()
     
     root.protocol("WM_DELETE_WINDOW", on_closing)
     headers_var = StringVar(value="Select a CSV file to see available tags.")
 
-    def get_custom_text():
-        return text_widget.get("1.0", "end-1c")
-
     Label(root, text="Template PDF:").grid(row=0, column=0)
     Entry(root, textvariable=template_var, width=50).grid(row=0, column=1)
     Button(root, text="Browse", command=lambda: select_file(template_var, "PDF")).grid(row=0, column=2)
 
     Label(root, text="CSV File:").grid(row=1, column=0)
     Entry(root, textvariable=csv_var, width=50).grid(row=1, column=1)
-    Button(root, text="Browse", command=lambda: [select_file(csv_var, "CSV"), update_csv_headers(csv_var, headers_var)]).grid(row=1, column=2)
+    Button(root, text="Browse", command=lambda: [select_file(csv_var, "CSV"), update_csv_headers(csv_var, headers_var, query_var.get())]).grid(row=1, column=2)
 
-    Label(root, text="Output Directory:").grid(row=2, column=0)
-    Entry(root, textvariable=output_dir_var, width=50).grid(row=2, column=1)
-    Button(root, text="Browse", command=lambda: select_directory(output_dir_var)).grid(row=2, column=2)
+    Label(root, text="SQL Query (SQLite only):").grid(row=2, column=0)
+    query_entry = Entry(root, textvariable=query_var, width=50)
+    query_entry.grid(row=2, column=1)
+    # The tags follow the query's columns once it is finished
+    query_entry.bind('<Return>', lambda event: update_csv_headers(csv_var, headers_var, query_var.get()))
+    query_entry.bind('<FocusOut>', lambda event: update_csv_headers(csv_var, headers_var, query_var.get()))
 
-    Label(root, text="Text:").grid(row=3, column=0)
+    Label(root, text="Output Directory:").grid(row=3, column=0)
+    Entry(root, textvariable=output_dir_var, width=50).grid(row=3, column=1)
+    Button(root, text="Browse", command=lambda: select_directory(output_dir_var)).grid(row=3, column=2)
+
+    Label(root, text="Text:").grid(row=4, column=0)
     
     # Add note about special characters
-    Label(root, text="Use \\n to force new line, and \\t for tab", font=('TkDefaultFont', 8)).grid(row=3, column=1, sticky='w')
+    Label(root, text="Use \\n to force new line, and \\t for tab", font=('TkDefaultFont', 8)).grid(row=4, column=1, sticky='w')
     
     # Create a frame for the toolbar
     toolbar_frame = Frame(root)
-    toolbar_frame.grid(row=3, column=1, sticky='e')
+    toolbar_frame.grid(row=4, column=1, sticky='e')
     
     # Create text frame with scrollbar
     text_frame = Frame(root)
-    text_frame.grid(row=4, column=1, sticky='nsew')
+    text_frame.grid(row=5, column=1, sticky='nsew')
     
     # Configure text widget with UTF-8 and IME support
     text_widget = Text(text_frame, width=50, height=10, wrap='word', undo=True)
@@ -541,6 +397,15 @@ def main():
     text_widget.pack(side='left', fill='both', expand=True)
     scrollbar.pack(side='right', fill='y')
     
+    # Configure font for display
+    def configure_format_tag(tag):
+        if tag == "bold":
+            text_widget.tag_configure(tag, font=font.Font(weight="bold"))
+        elif tag == "italic":
+            text_widget.tag_configure(tag, font=font.Font(slant="italic"))
+        elif tag == "underline":
+            text_widget.tag_configure(tag, underline=True)
+
     # Define text formatting functions
     def apply_format(tag, font_config):
         try:
@@ -561,13 +426,8 @@ def main():
             else:
                 # Add formatting
                 text_widget.tag_add(tag, selection_start, selection_end)
-                # Configure font for display
-                if tag == "bold":
-                    text_widget.tag_configure(tag, font=font.Font(weight="bold"))
-                elif tag == "italic":
-                    text_widget.tag_configure(tag, font=font.Font(slant="italic"))
-                elif tag == "underline":
-                    text_widget.tag_configure(tag, underline=True)
+                configure_format_tag(tag)
+            save_current_settings()
         except Exception as e:
             messagebox.showerror("Error", str(e))
     
@@ -636,11 +496,9 @@ def main():
     
     text_widget.bind('<Key>', handle_shortcuts)
     
-    text_input_help = "Type your text here. Use {tags} for CSV values. Tags are case-sensitive, e.g. {name} and are defined as the CSV column headers."
-
     # Clear default text when clicked
     def clear_default_text(event):
-        if text_widget.get("1.0", "end-1c") == text_input_help:
+        if text_widget.get("1.0", "end-1c") == TEXT_INPUT_HELP:
             text_widget.delete("1.0", "end")
             text_widget.unbind('<Button-1>')
     
@@ -648,56 +506,183 @@ def main():
     saved_text = settings.get("text_content", "")
     if saved_text:
         text_widget.insert("1.0", saved_text)
+        # Restore bold/italic/underline from their saved character offsets
+        for tag, ranges in settings.get("text_format_ranges", {}).items():
+            if tag not in FORMAT_TAGS:
+                continue
+            for start, end in ranges:
+                text_widget.tag_add(tag, f"1.0 + {start} chars", f"1.0 + {end} chars")
+            configure_format_tag(tag)
     else:
-        text_widget.insert("1.0", text_input_help)
+        text_widget.insert("1.0", TEXT_INPUT_HELP)
         text_widget.bind('<Button-1>', clear_default_text)
 
     # Save text content when it changes
     def on_text_change(event=None):
-        if text_widget.get("1.0", "end-1c") != text_input_help:
-            save_current_settings()
+        # <<Modified>> only fires when the modified flag changes, so clear it
+        # to hear about the next edit too; clearing fires it once more
+        if not text_widget.edit_modified():
+            return
+        text_widget.edit_modified(False)
+        save_current_settings()
     
     text_widget.bind('<<Modified>>', on_text_change)
 
-    Label(root, textvariable=headers_var, wraplength=400, justify="left").grid(row=5, column=1)
+    Label(root, textvariable=headers_var, wraplength=400, justify="left").grid(row=6, column=1)
+
+    Label(root, text="Font:").grid(row=7, column=0)
+    # Built-in PDF fonts with style variants, then TrueType families added below
+    font_options = list(BASE_FAMILIES) + [name for name in settings["custom_fonts"] if name not in BASE_FAMILIES]
+    if font_var.get() not in font_options:
+        font_var.set("Helvetica")  # Default to Helvetica as it's always available
+    font_menu = OptionMenu(root, font_var, *font_options)
+    font_menu.grid(row=7, column=1)
+
+    def add_font_family():
+        paths = select_font_files()
+        if not paths:
+            return
+        font_files = guess_styles(paths)
+        name = family_name(font_files)
+        if name in BASE_FAMILIES:
+            name += " (TrueType)"
+        # Keep the family in the settings so the render command and later sessions find it
+        settings["custom_fonts"] = dict(settings["custom_fonts"], **{name: font_files})
+        if name not in font_options:
+            font_options.append(name)
+            font_menu["menu"].add_command(label=name, command=lambda: font_var.set(name))
+        font_var.set(name)
 
-    Label(root, text="Font:").grid(row=6, column=0)
-    font_options = ["Helvetica", "Times-Roman", "Courier"]  # Built-in PDF fonts with style variants
-    font_var.set("Helvetica")  # Default to Helvetica as it's always available
-    OptionMenu(root, font_var, *font_options).grid(row=6, column=1)
+    Button(root, text="Add Font...", command=add_font_family).grid(row=7, column=2)
 
-    Label(root, text="Font Size:").grid(row=7, column=0)
-    Entry(root, textvariable=font_size_var).grid(row=7, column=1)
+    Label(root, text="Font Size:").grid(row=8, column=0)
+    Entry(root, textvariable=font_size_var).grid(row=8, column=1)
 
-    Label(root, text="Text X Position (%):").grid(row=8, column=0)
-    Entry(root, textvariable=x_percent_var).grid(row=8, column=1)
+    Label(root, text="Text X Position (%):").grid(row=9, column=0)
+    Entry(root, textvariable=x_percent_var).grid(row=9, column=1)
 
-    Label(root, text="Text Y Position (%):").grid(row=9, column=0)
-    Entry(root, textvariable=y_percent_var).grid(row=9, column=1)
+    Label(root, text="Text Y Position (%):").grid(row=10, column=0)
+    Entry(root, textvariable=y_percent_var).grid(row=10, column=1)
 
-    Label(root, text="Chars per Line:").grid(row=10, column=0)
-    Entry(root, textvariable=max_chars_var).grid(row=10, column=1)
+    Label(root, text="Wrap Lines By:").grid(row=11, column=0)
+    OptionMenu(root, wrap_mode_var, *WRAP_MODE_LABELS.values()).grid(row=11, column=1)
+
+    Label(root, text="Chars per Line:").grid(row=12, column=0)
+    Entry(root, textvariable=max_chars_var).grid(row=12, column=1)
+
+    Label(root, text="Line Width (%):").grid(row=13, column=0)
+    Entry(root, textvariable=line_width_var).grid(row=13, column=1)
+
+    Label(root, text="Filename with tags:").grid(row=14, column=0)
+    Entry(root, textvariable=filename_prefix_var).grid(row=14, column=1)
+
+    Label(root, text="Output:").grid(row=15, column=0)
+    OptionMenu(root, output_mode_var, *OUTPUT_MODE_LABELS.values()).grid(row=15, column=1)
+    OptionMenu(root, archive_var, *ARCHIVE_LABELS.values()).grid(row=15, column=2)
+
+    Label(root, text="Merged Filename:").grid(row=16, column=0)
+    Entry(root, textvariable=merged_filename_var).grid(row=16, column=1)
+
+    Label(root, text="Subfolders (hash or a tag; empty = none):").grid(row=17, column=0)
+    Entry(root, textvariable=shard_by_var).grid(row=17, column=1)
+
+    Label(root, text="Worker Processes (0 = all cores):").grid(row=18, column=0)
+    Entry(root, textvariable=workers_var).grid(row=18, column=1)
+
+    Label(root, text="Rows (e.g. 1-50, city=Madrid; empty = all):").grid(row=19, column=0)
+    Entry(root, textvariable=row_selection_var).grid(row=19, column=1)
+
+    progress_var = StringVar(value="")
+    messages = queue.Queue()
+    run_state = {}  # Thread, cancel event, start time and row total of the running batch
+
+    def start_generation():
+        from render import resolve_workers
+        try:
+            job = build_job(output_dir_var.get())
+            workers = resolve_workers(workers_var.get())
+            csv_path = csv_var.get()
+            if not csv_path:
+                raise ValueError("All fields are required!")
+        except Exception as e:
+            messagebox.showerror("Error", str(e))
+            return
+
+        cancel_event = threading.Event()
+        run_state.update(cancel_event=cancel_event, started=time.monotonic(), total=0)
+        generate_button.config(state='disabled')
+        cancel_button.config(state='normal')
+        progress_var.set("Starting...")
+        thread = threading.Thread(target=generate_pdfs, args=(job, csv_path, workers, messages, cancel_event, settings["metrics_dir"], settings["incremental"], row_selection_var.get(), query_var.get()), daemon=True)
+        run_state["thread"] = thread
+        thread.start()
+        root.after(100, poll_progress)
+
+    def cancel_generation():
+        if run_state.get("cancel_event") is not None:
+            run_state["cancel_event"].set()
+            cancel_button.config(state='disabled')
+            progress_var.set(progress_var.get() + "   Cancelling...")
+
+    def poll_progress():
+        while True:
+            try:
+                kind, value = messages.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == "total":
+                run_state["total"] = value
+            elif kind == "progress":
+                progress_var.set(format_progress(value, run_state["total"], time.monotonic() - run_state["started"]))
+            elif kind == "warning":
+                messagebox.showwarning("Warning", value)
+            elif kind == "skipped":
+                run_state["skipped"] = value
+            elif kind == "cache":
+                run_state["cache"] = value
+            else:
+                cancelled = run_state["cancel_event"].is_set()
+                skipped = run_state.get("skipped", 0)
+                hits, misses = run_state.get("cache", (0, 0))
+                run_state.clear()
+                generate_button.config(state='normal')
+                cancel_button.config(state='disabled')
+                if kind == "error":
+                    progress_var.set("")
+                    messagebox.showerror("Error", value)
+                elif cancelled:
+                    messagebox.showinfo("Cancelled", f"Generation cancelled after {value} rows.")
+                else:
+                    message = "PDFs generated successfully!"
+                    if skipped:
+                        message += f"\n{skipped} unchanged PDFs were kept as they were."
+                    if hits + misses:
+                        message += f"\nPage cache: {hits} hits, {misses} misses."
+                    messagebox.showinfo("Success", message)
+                return
+        root.after(100, poll_progress)
 
-    Label(root, text="Filename with tags:").grid(row=11, column=0)
-    Entry(root, textvariable=filename_prefix_var).grid(row=11, column=1)
+    button_frame = Frame(root)
+    button_frame.grid(row=20, column=1)
+    generate_button = Button(button_frame, text="Generate PDFs", command=start_generation)
+    generate_button.pack(side='left', padx=4)
+    cancel_button = Button(button_frame, text="Cancel", command=cancel_generation, state='disabled')
+    cancel_button.pack(side='left', padx=4)
+    Button(button_frame, text="Preview", command=open_preview).pack(side='left', padx=4)
 
-    Button(root, text="Generate PDFs", command=lambda: generate_pdfs(
-        root,
-        template_var.get(),
-        csv_var.get(),
-        output_dir_var.get(),
-        filename_prefix_var.get(),
-        get_custom_text(),
-        font_var.get(),
-        font_size_var.get(),
-        x_percent_var.get(),
-        y_percent_var.get(),
-        max_chars_var.get(),
-        text_widget
-    )).grid(row=12, column=1)
+    Label(root, textvariable=progress_var).grid(row=21, column=1)
 
     root.mainloop()
 
 
 if __name__ == "__main__":
+    if getattr(sys, "frozen", False):
+        # Needed for the process pool in the PyInstaller build
+        import multiprocessing
+        multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        # Subcommands such as "render" run headless
+        import cli
+        sys.exit(cli.main(sys.argv[1:]))
     main()
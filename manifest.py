@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+
+
+MANIFEST_FILE = "csv2pdf_manifest.jsonl"
+
+# Bump when a change to rendering makes earlier output stale
+RENDER_VERSION = 1
+
+# Bytes at the end of each file that are hashed to tell it is still intact
+TAIL_BYTES = 4096
+
+
+def file_digest(path):
+    """Return the SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def tail_digest(*parts):
+    """Return the SHA-256 of the last TAIL_BYTES of parts written one after another"""
+    tail = b""
+    for part in reversed(parts):
+        tail = part[-(TAIL_BYTES - len(tail)):] + tail
+        if len(tail) == TAIL_BYTES:
+            break
+    return hashlib.sha256(tail).hexdigest()
+
+
+def job_fingerprint(job):
+    """Hash everything except the row values that an output file depends on"""
+    settings = {
+        "version": RENDER_VERSION,
+        "template": file_digest(job.template_path),
+        "text": job.text_plan.parts,
+        "fonts": job.fonts,
+        "font_size": job.font_size,
+        "x": job.x,
+        "y": job.y,
+        "max_chars": job.max_chars,
+        "wrap_mode": job.wrap_mode,
+        "line_width": job.line_width,
+        "output_mode": job.output_mode,
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+class Manifest:
+    """Journal of the files in an output directory and the inputs each was rendered from
+
+    Every rendered file is appended as one JSON line as soon as it is written,
+    so a run that is interrupted keeps what it finished. close() rewrites the
+    journal with one line per file. With reuse=False no file counts as
+    current, but the entries of files this run does not write are kept.
+    """
+
+    def __init__(self, directory, reuse=True):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        self.entries = {}  # filename -> (digest, size, tail digest)
+        self.reuse = reuse
+        self.skipped = 0
+        self._fingerprint = None
+        self._tags = ()
+        self._journal = None
+        self._read()
+
+    def __getstate__(self):
+        # Worker processes get the entries to check rows against, never the journal
+        return dict(self.__dict__, _journal=None, skipped=0)
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+                self.entries[entry["file"]] = (entry["digest"], entry["size"], entry["tail"])
+            except (ValueError, KeyError, TypeError):
+                # A line cut short by a crash, or from before tails were
+                # recorded; its file is rendered again
+                continue
+
+    def begin(self, job):
+        """Fingerprint a prepared job so rows can be compared with earlier runs"""
+        self._fingerprint = job_fingerprint(job)
+        self._tags = job.text_plan.tags
+
+    def digest(self, row):
+        values = json.dumps([row.get(tag) for tag in self._tags])
+        return hashlib.sha256((self._fingerprint + values).encode()).hexdigest()
+
+    def is_current(self, filename, digest):
+        """True if filename was rendered from the same inputs and still has the size and last bytes it was written with
+
+        Only the end of the file is read, so damage before its last
+        TAIL_BYTES that keeps the size goes unnoticed.
+        """
+        entry = self.entries.get(filename) if self.reuse else None
+        if entry is None or entry[0] != digest:
+            return False
+        try:
+            with open(os.path.join(self.directory, filename), "rb") as f:
+                size = f.seek(0, os.SEEK_END)
+                if size != entry[1]:
+                    return False
+                f.seek(max(size - TAIL_BYTES, 0))
+                return tail_digest(f.read()) == entry[2]
+        except OSError:
+            return False
+
+    def record(self, filename, digest, written):
+        """Add a file written by RenderJob.write_row(), given the (size, tail digest) it returned"""
+        size, tail = written
+        self.entries[filename] = (digest, size, tail)
+        if self._journal is None:
+            self._journal = open(self.path, "a", encoding="utf-8")
+        self._journal.write(json.dumps({"file": filename, "digest": digest, "size": size, "tail": tail}) + "\n")
+        self._journal.flush()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if not self.entries:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for filename, (digest, size, tail) in self.entries.items():
+                f.write(json.dumps({"file": filename, "digest": digest, "size": size, "tail": tail}) + "\n")
+        os.replace(temp_path, self.path)
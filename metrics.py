@@ -0,0 +1,127 @@
+import json
+import os
+import time
+
+
+# Upper bounds, in seconds, of the per-row stage histograms
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Pipeline stages in the order a row goes through them
+STAGES = ("substitute", "layout", "draw", "merge", "write")
+
+COUNTERS = ("rows", "failures", "bytes_written", "cache_hits", "cache_misses")
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(STAGE_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for index, bound in enumerate(STAGE_BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def cumulative(self):
+        total = 0
+        for count in self.buckets:
+            total += count
+            yield total
+
+
+class Metrics:
+    """Per-stage timings and counters of one run
+
+    Instrumented code only calls into this when a Metrics is attached, so a
+    run without one pays a single None check per stage.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.started = time.time()
+        self.finished = None
+
+    def lap(self, stage, started):
+        """Record the time since started for stage and return the current time"""
+        now = time.perf_counter()
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = Histogram()
+        histogram.observe(now - started)
+        return now
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        """Add the measurements of another Metrics, e.g. one from a worker process"""
+        for stage, histogram in other.stages.items():
+            self.stages.setdefault(stage, Histogram()).merge(histogram)
+        for name, value in other.counters.items():
+            self.count(name, value)
+
+    def finish(self):
+        self.finished = time.time()
+
+    def _ordered_stages(self):
+        order = {stage: index for index, stage in enumerate(STAGES)}
+        return sorted(self.stages.items(), key=lambda item: order.get(item[0], len(order)))
+
+    def to_dict(self):
+        finished = self.finished or time.time()
+        return {
+            "started": self.started,
+            "run_seconds": finished - self.started,
+            "counters": dict(self.counters),
+            "stages": {
+                stage: {
+                    "count": histogram.count,
+                    "sum_seconds": histogram.sum,
+                    "mean_seconds": histogram.sum / histogram.count if histogram.count else 0.0,
+                    "max_seconds": histogram.max,
+                    "buckets": {str(bound): total for bound, total in zip(STAGE_BUCKETS, histogram.cumulative())},
+                }
+                for stage, histogram in self._ordered_stages()
+            },
+        }
+
+    def to_prometheus(self):
+        finished = self.finished or time.time()
+        lines = [
+            "# HELP csv2pdf_stage_seconds Time spent per row in each rendering stage.",
+            "# TYPE csv2pdf_stage_seconds histogram",
+        ]
+        for stage, histogram in self._ordered_stages():
+            for bound, total in zip(STAGE_BUCKETS, histogram.cumulative()):
+                lines.append(f'csv2pdf_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {total}')
+            lines.append(f'csv2pdf_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'csv2pdf_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'csv2pdf_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, value in self.counters.items():
+            lines.append(f"# TYPE csv2pdf_{name}_total counter")
+            lines.append(f"csv2pdf_{name}_total {value}")
+        lines.append("# TYPE csv2pdf_run_seconds gauge")
+        lines.append(f"csv2pdf_run_seconds {finished - self.started}")
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, directory):
+        """Write csv2pdf_metrics.json and csv2pdf_metrics.prom into directory"""
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "csv2pdf_metrics.json"), "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        with open(os.path.join(directory, "csv2pdf_metrics.prom"), "w") as f:
+            f.write(self.to_prometheus())
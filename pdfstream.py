@@ -0,0 +1,217 @@
+import hashlib
+from io import BytesIO
+from PyPDF2.generic import (
+    ArrayObject, DecodedStreamObject, DictionaryObject, EncodedStreamObject,
+    IndirectObject, NameObject, NumberObject, StreamObject,
+)
+
+
+# Keys that point back up the source document's tree; following them would
+# drag unrelated pages into the output
+SKIPPED_KEYS = ("/Parent", "/P")
+
+# Marks an object whose copy is being made, to catch references back to it
+_COPYING = object()
+
+
+class PdfObjectWriter:
+    """Writes numbered PDF objects to a file, copying what they reference from other documents
+
+    Objects passed to share() are written once and every later object that
+    contains them refers to that single copy.
+    """
+
+    def __init__(self, file, first_number=1, base_offset=0):
+        self._file = file
+        self._base_offset = base_offset  # Bytes that precede file in the finished PDF
+        self._offsets = {}  # object number -> (offset, generation)
+        self._next_number = first_number
+        self._sources = {}  # id(pdf) -> (pdf, {source idnum: new idnum}) for shared documents
+        self._shared = {}  # id(obj) -> (obj, reference)
+        self._unique = {}  # SHA-256 of a serialized object -> idnum, for objects of unshared documents
+
+    def share(self, obj, source=None):
+        """Write obj (and what it references in source) once and return its reference"""
+        if source is not None and id(source) not in self._sources:
+            self._sources[id(source)] = (source, {})
+        if id(obj) in self._shared:
+            return self._shared[id(obj)][1]
+        reference = self._add(self._copy(obj, {}))
+        self._shared[id(obj)] = (obj, reference)
+        return reference
+
+    def add(self, obj):
+        """Write obj, copying the objects it references, and return its reference"""
+        return self._add(self._copy(obj, {}))
+
+    def _reserve(self):
+        number = self._next_number
+        self._next_number += 1
+        self._offsets[number] = None
+        return number
+
+    def _write(self, number, obj, generation=0):
+        self._offsets[number] = (self._base_offset + self._file.tell(), generation)
+        self._file.write(f"{number} {generation} obj\n".encode())
+        obj.write_to_stream(self._file, None)
+        self._file.write(b"\nendobj\n")
+
+    def _add_unique(self, obj):
+        # Write obj unless an identical object was written already
+        data = BytesIO()
+        obj.write_to_stream(data, None)
+        data = data.getvalue()
+        digest = hashlib.sha256(data).digest()
+        number = self._unique.get(digest)
+        if number is None:
+            number = self._unique[digest] = self._reserve()
+            self._offsets[number] = (self._base_offset + self._file.tell(), 0)
+            self._file.write(f"{number} 0 obj\n".encode() + data + b"\nendobj\n")
+        return number
+
+    def _add(self, obj):
+        number = self._reserve()
+        self._write(number, obj)
+        return IndirectObject(number, 0, self)
+
+    def _write_xref(self):
+        """Write the cross-reference section for every object written, grouped into runs of numbers"""
+        # Object 0 heads the free list; updates repeat it so readers see the section start at 0
+        entries = {number: f"{offset:010d} {generation:05d} n \n" for number, (offset, generation) in self._offsets.items()}
+        entries[0] = "0000000000 65535 f \n"
+        offset = self._base_offset + self._file.tell()
+        lines = ["xref\n"]
+        numbers = sorted(entries)
+        start = 0
+        for index in range(1, len(numbers) + 1):
+            if index == len(numbers) or numbers[index] != numbers[index - 1] + 1:
+                lines.append(f"{numbers[start]} {index - start}\n")
+                lines.extend(entries[number] for number in numbers[start:index])
+                start = index
+        self._file.write("".join(lines).encode())
+        return offset
+
+    def _write_trailer(self, trailer, xref_offset):
+        self._file.write(b"trailer\n")
+        trailer.write_to_stream(self._file, None)
+        self._file.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+
+    def _convert(self, obj, memo):
+        # Return obj as it should appear inside another object of this file
+        if id(obj) in self._shared:
+            return self._shared[id(obj)][1]
+        if isinstance(obj, IndirectObject):
+            if obj.pdf is self:
+                return obj
+            # Objects of shared documents are remembered for the whole file,
+            # anything else only for the page being added
+            source = self._sources.get(id(obj.pdf))
+            numbers, key = (source[1], obj.idnum) if source is not None else (memo, (id(obj.pdf), obj.idnum))
+            number = numbers.get(key)
+            if number is _COPYING:
+                # A reference back to an object being copied gives it a number of its own
+                number = numbers[key] = self._reserve()
+            elif number is None:
+                resolved = obj.get_object()
+                if source is not None:
+                    number = numbers[key] = self._reserve()
+                    self._write(number, self._copy(resolved, memo))
+                else:
+                    numbers[key] = _COPYING
+                    copy = self._copy(resolved, memo)
+                    number = numbers[key]
+                    if number is _COPYING:
+                        # Identical objects of different overlays, such as their
+                        # fonts and embedded font files, are written once for the whole file
+                        number = self._add_unique(copy)
+                    else:
+                        self._write(number, copy)
+                    numbers[key] = number
+            return IndirectObject(number, 0, self)
+        if isinstance(obj, StreamObject):
+            # Streams can only be stored as indirect objects
+            return self._add(self._copy(obj, memo))
+        return self._copy(obj, memo)
+
+    def _copy(self, obj, memo):
+        if isinstance(obj, StreamObject):
+            copy = EncodedStreamObject() if isinstance(obj, EncodedStreamObject) else DecodedStreamObject()
+            copy._data = obj._data
+        elif isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+        elif isinstance(obj, ArrayObject):
+            return ArrayObject(self._convert(item, memo) for item in obj)
+        else:
+            return obj
+        for key, value in obj.items():
+            if key not in SKIPPED_KEYS:
+                copy[NameObject(key)] = self._convert(value, memo)
+        return copy
+
+
+class StreamingPdfWriter(PdfObjectWriter):
+    """Writes a multi-page PDF object by object, so finished pages never pile up in memory"""
+
+    def __init__(self, path):
+        super().__init__(open(path, "wb"))
+        self._page_numbers = []
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self._pages_ref = IndirectObject(self._reserve(), 0, self)
+
+    def add_page(self, page):
+        """Append a page; objects it references are written now unless already shared"""
+        memo = {}
+        page_dict = DictionaryObject()
+        for key, value in page.items():
+            if key not in SKIPPED_KEYS:
+                page_dict[NameObject(key)] = self._convert(value, memo)
+        page_dict[NameObject("/Parent")] = self._pages_ref
+        self._page_numbers.append(self._add(page_dict).idnum)
+
+    def close(self):
+        if self._file.closed:
+            return
+        pages = DictionaryObject()
+        pages[NameObject("/Type")] = NameObject("/Pages")
+        pages[NameObject("/Kids")] = ArrayObject(IndirectObject(number, 0, self) for number in self._page_numbers)
+        pages[NameObject("/Count")] = NumberObject(len(self._page_numbers))
+        self._write(self._pages_ref.idnum, pages)
+
+        catalog = DictionaryObject()
+        catalog[NameObject("/Type")] = NameObject("/Catalog")
+        catalog[NameObject("/Pages")] = self._pages_ref
+        root = self._add(catalog)
+
+        trailer = DictionaryObject()
+        trailer[NameObject("/Size")] = NumberObject(self._next_number)
+        trailer[NameObject("/Root")] = root
+        self._write_trailer(trailer, self._write_xref())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PdfUpdateWriter(PdfObjectWriter):
+    """Writes an incremental update to be appended to an existing PDF
+
+    New objects are numbered from the original's /Size; replace() writes a
+    new version of one of the original's objects, whose values are written
+    as they are, so references to the original's objects stay valid.
+    """
+
+    def __init__(self, file, original_size, original_length):
+        super().__init__(file, first_number=original_size, base_offset=original_length)
+
+    def replace(self, number, generation, obj):
+        self._write(number, obj, generation)
+
+    def close(self, trailer, previous_xref):
+        """Write the update's xref and trailer; trailer gets /Size and /Prev added"""
+        trailer = DictionaryObject(trailer)
+        trailer[NameObject("/Size")] = NumberObject(self._next_number)
+        trailer[NameObject("/Prev")] = NumberObject(previous_xref)
+        self._write_trailer(trailer, self._write_xref())
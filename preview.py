@@ -0,0 +1,168 @@
+import os
+import threading
+from collections import OrderedDict
+from itertools import islice
+from reportlab.lib.pagesizes import letter
+from csvindex import CsvIndex
+from csvsplit import read_csv_range
+from sources import open_source
+
+
+# Paragraph layouts kept between refreshes
+PARAGRAPH_CACHE_SIZE = 2048
+
+# Rows read from the start of a CSV while its index is being built
+SEQUENTIAL_ROWS = 1000
+
+# Tk font families closest to the PDF base fonts
+TK_FAMILIES = {"Helvetica": "Helvetica", "Times-Roman": "Times", "Courier": "Courier"}
+
+
+def split_paragraphs(runs):
+    """Split (text, formats) runs at each newline into a tuple of runs per paragraph"""
+    paragraphs = []
+    current = []
+    for text, formats in runs:
+        pieces = text.split('\n')
+        for index, piece in enumerate(pieces):
+            if index:
+                paragraphs.append(tuple(current))
+                current = []
+            if piece:
+                current.append((piece, formats))
+    paragraphs.append(tuple(current))
+    return paragraphs
+
+
+class PreviewLayout:
+    """Lays out rows a paragraph at a time with the renderer's own layout code
+
+    Wrapping restarts after every newline, so each paragraph can be laid out
+    on its own. Paragraphs are cached by their text, formatting and the job's
+    layout settings; an edit only lays out the paragraphs it changed.
+    """
+
+    def __init__(self, max_paragraphs=PARAGRAPH_CACHE_SIZE):
+        self.max_paragraphs = max_paragraphs
+        self._paragraphs = OrderedDict()
+
+    @staticmethod
+    def _settings_key(job):
+        return (job.fonts, job.font_size, job.x, job.wrap_mode, job.max_chars, job.line_width)
+
+    def _paragraph_lines(self, job, settings_key, runs):
+        key = (settings_key, runs)
+        lines = self._paragraphs.get(key)
+        if lines is not None:
+            self._paragraphs.move_to_end(key)
+            return lines
+        styled, line_spans = job.layout(runs)
+        lines = [pieces for y, pieces in job.placed_lines(styled, line_spans)]
+        self._paragraphs[key] = lines
+        if len(self._paragraphs) > self.max_paragraphs:
+            self._paragraphs.popitem(last=False)
+        return lines
+
+    def lines(self, job, runs):
+        """Return (y, pieces) for every line, as RenderJob.placed_lines would for the whole text"""
+        settings_key = self._settings_key(job)
+        placed = []
+        for index, paragraph in enumerate(split_paragraphs(runs)):
+            if index:
+                # The newline itself leaves an empty line
+                placed.append([])
+            placed.extend(self._paragraph_lines(job, settings_key, paragraph))
+
+        # Step down line by line as placed_lines does, so positions match exactly
+        line_height = job.font_size * 1.2
+        y_pos = letter[1] - job.y * letter[1]
+        lines = []
+        for pieces in placed:
+            lines.append((y_pos, pieces))
+            y_pos -= line_height
+        return lines
+
+
+class PreviewRows:
+    """Reads single rows of a CSV through its row index, reusing the index while the file is unchanged
+
+    The index is built in a background thread and kept in memory, so the
+    preview neither holds up the window nor writes beside the CSV; until it
+    is ready the first rows are read from the start of the file. Inputs that
+    cannot be indexed, such as compressed files or SQLite queries, are
+    always read from the start up to the row.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._version = None
+        self._building = None  # (version, thread, [index or error]) of the index being built
+
+    def row(self, csv_path, number, query=""):
+        """Return the headers and the row with the given 1-based number, or None while the CSV is being indexed"""
+        source = open_source(csv_path, query)
+        if source.splittable:
+            index = self._ready_index(csv_path)
+            if index is not None:
+                if not 1 <= number <= index.row_count:
+                    raise ValueError(f"Row must be between 1 and {index.row_count}")
+                start, end, size = index.spans([number])[0]
+                return index.headers, next(iter(read_csv_range(csv_path, start, end, index.headers)))
+            if number > SEQUENTIAL_ROWS:
+                return None
+
+        if number >= 1:
+            for row in islice(source.rows(), number - 1, None):
+                return source.headers, row
+        raise ValueError(f"Row {number} is not in {os.path.basename(csv_path)}")
+
+    def _ready_index(self, csv_path):
+        # Return the index of the CSV as it is now, or None after starting or while waiting for its build
+        stat = os.stat(csv_path)
+        version = (os.path.abspath(csv_path), stat.st_mtime_ns, stat.st_size)
+        if version == self._version:
+            return self._index
+        if self._building is None or self._building[0] != version:
+            result = []
+            thread = threading.Thread(target=self._build, args=(csv_path, result), daemon=True)
+            self._building = (version, thread, result)
+            thread.start()
+            return None
+        version, thread, result = self._building
+        if thread.is_alive():
+            return None
+        self._building = None
+        if isinstance(result[0], Exception):
+            raise result[0]
+        self._index, self._version = result[0], version
+        return self._index
+
+    @staticmethod
+    def _build(csv_path, result):
+        try:
+            result.append(CsvIndex(csv_path, save=False))
+        except Exception as e:
+            result.append(e)
+
+
+def draw_preview(canvas, job, lines, scale):
+    """Draw the template's page box and the laid out lines on a Tk canvas"""
+    from render import load_template
+    box = load_template(job.template_path).page.mediabox
+    page_width, page_height = float(box.width), float(box.height)
+
+    canvas.delete("all")
+    canvas.configure(width=page_width * scale + 2, height=page_height * scale + 2)
+    canvas.create_rectangle(1, 1, page_width * scale + 1, page_height * scale + 1, outline="gray50", fill="white")
+
+    family = TK_FAMILIES.get(job.fonts[0], "Helvetica")  # TrueType families are shown in Helvetica
+    size = -max(int(round(job.font_size * scale)), 1)  # Negative sizes are in pixels
+    for y_pos, pieces in lines:
+        # PDF y grows upwards from the bottom of the template page
+        y = (page_height - y_pos) * scale + 1
+        for x_pos, segment, font_name, width, formats in pieces:
+            x = x_pos * scale + 1
+            style = ("bold" if 'bold' in formats else "normal", "italic" if 'italic' in formats else "roman")
+            canvas.create_text(x, y, text=segment, anchor="sw", font=(family, size) + style)
+            if 'underline' in formats:
+                canvas.create_line(x, y + 1, x + width * scale, y + 1)
@@ -0,0 +1,1037 @@
+import os
+import re
+import csv
+import time
+import hashlib
+import multiprocessing
+from collections import OrderedDict, deque
+from itertools import chain, islice, repeat
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from reportlab.lib.pagesizes import letter
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, DictionaryObject, NameObject, NumberObject, StreamObject
+from PyPDF2._page import PageObject
+from fonts import font_family
+from csvindex import CsvIndex, SavedRenames, row_filter, select_rows
+from sources import SqliteSource, open_source
+from csvsplit import read_csv_header, read_csv_range, split_csv
+from metrics import Metrics
+from manifest import tail_digest
+from archive import ARCHIVE_FORMATS, ArchiveWriter, archive_filename
+from layout import WRAP_MODES, StyledText, width_measure, wrap_spans
+from filenames import FilenamePlan
+from pdfstream import PdfUpdateWriter, StreamingPdfWriter
+from settings import OUTPUT_MODES
+
+
+TEMPLATE_FORM_NAME = "/CSV2PDFTemplate"
+OVERLAY_FORM_NAME = "/CSV2PDFOverlay"
+
+# Rows, roughly, in each byte range of the CSV a worker process parses in parallel mode
+DEFAULT_CHUNK_SIZE = 32
+
+# Bytes of finished pages each process keeps for rows that render identically
+PAGE_CACHE_BYTES = 32 * 1024 * 1024
+
+STARTXREF_RE = re.compile(rb"startxref\s+(\d+)")
+XREF_START_RE = re.compile(rb"\s*(xref|\d+\s+\d+\s+obj)")
+
+
+def _stream(data):
+    stream = DecodedStreamObject()
+    stream.set_data(data)
+    return stream
+
+
+def _content_data(contents):
+    # /Contents is one stream or an array of streams drawn one after another
+    if contents is None:
+        return b""
+    contents = contents.get_object()
+    if isinstance(contents, ArrayObject):
+        return b"\n".join(item.get_object().get_data() for item in contents)
+    return contents.get_data()
+
+
+class Template:
+    """First page of a template PDF, parsed once and wrapped as a Form XObject"""
+
+    def __init__(self, path, version=None):
+        self.reader = PdfReader(path)
+        if not self.reader.pages:
+            raise ValueError(f"Template has no pages: {path}")
+        self.page = self.reader.pages[0]
+        self.form = self._build_form(self.page)
+        # Content stream placed before each overlay to draw the form
+        self.prefix = DecodedStreamObject()
+        self.prefix.set_data(f"q {TEMPLATE_FORM_NAME} Do Q\n".encode())
+        self.prefix.indirect_reference = None
+        self.path = path
+        self.version = version  # Path, mtime and size of the file parsed
+        self._splice = None
+
+    @staticmethod
+    def _build_form(page):
+        # Decode the page contents once; every row then only references the form
+        form = _stream(_content_data(page.get("/Contents"))).flate_encode()
+        form.indirect_reference = None
+        form[NameObject("/Type")] = NameObject("/XObject")
+        form[NameObject("/Subtype")] = NameObject("/Form")
+        form[NameObject("/FormType")] = NumberObject(1)
+        form[NameObject("/BBox")] = page.mediabox
+        if "/Resources" in page:
+            form[NameObject("/Resources")] = page["/Resources"].get_object()
+        return form
+
+    def merge(self, overlay_page):
+        """Return a new page with the template drawn underneath the overlay"""
+        page = PageObject()
+        for key, value in self.page.items():
+            if key not in ("/Contents", "/Resources", "/Parent"):
+                page[NameObject(key)] = value
+
+        resources = DictionaryObject()
+        overlay_resources = overlay_page.get("/Resources")
+        if overlay_resources is not None:
+            resources.update(overlay_resources.get_object())
+        xobjects = DictionaryObject()
+        if "/XObject" in resources:
+            xobjects.update(resources["/XObject"].get_object())
+        xobjects[NameObject(TEMPLATE_FORM_NAME)] = self.form
+        resources[NameObject("/XObject")] = xobjects
+        page[NameObject("/Resources")] = resources
+
+        # Draw the template in its own graphics state, then the overlay on top
+        contents = ArrayObject([self.prefix])
+        overlay_contents = overlay_page.get("/Contents")
+        if overlay_contents is not None:
+            overlay_contents = overlay_contents.get_object()
+            if isinstance(overlay_contents, ArrayObject):
+                contents.extend(item.get_object() for item in overlay_contents)
+            else:
+                contents.append(overlay_contents)
+        page[NameObject("/Contents")] = contents
+        return page
+
+    def _splice_base(self):
+        # Everything an incremental update needs from the template, found once
+        if self._splice is not None:
+            return self._splice
+        reader = self.reader
+        if reader.is_encrypted:
+            raise ValueError("Encrypted templates cannot be used in spliced mode")
+        with open(self.path, "rb") as f:
+            data = f.read()
+        match = None
+        for match in STARTXREF_RE.finditer(data, max(len(data) - 1024, 0)):
+            pass
+        if match is None or not XREF_START_RE.match(data, int(match.group(1))):
+            raise ValueError("Template's cross-reference table is damaged; use another output mode")
+        if not data.endswith((b"\n", b"\r")):
+            data += b"\n"
+
+        # The page keeps its object number; the page tree is cut down to it
+        # so the file shows one page, as in the other modes
+        page_ref = self.page.indirect_reference
+        pages_ref = reader.trailer["/Root"].raw_get("/Pages")
+        pages = DictionaryObject()
+        for key, value in pages_ref.get_object().items():
+            if key not in ("/Kids", "/Count", "/Parent"):
+                pages[NameObject(key)] = value
+        pages[NameObject("/Kids")] = ArrayObject([page_ref])
+        pages[NameObject("/Count")] = NumberObject(1)
+
+        # reader.pages already copied inherited attributes onto the page
+        page = DictionaryObject()
+        for key, value in self.page.items():
+            if key not in ("/Contents", "/Resources", "/Parent"):
+                page[NameObject(key)] = value
+        page[NameObject("/Parent")] = pages_ref
+
+        resources = DictionaryObject()
+        if "/Resources" in self.page:
+            resources.update(self.page["/Resources"].get_object())
+        xobjects = DictionaryObject()
+        if "/XObject" in resources:
+            xobjects.update(resources["/XObject"].get_object())
+
+        contents = self.page.get("/Contents")
+        if contents is None:
+            contents = []
+        elif isinstance(contents.get_object(), ArrayObject):
+            contents = list(contents.get_object())
+        else:
+            contents = [self.page.raw_get("/Contents")]
+
+        trailer = DictionaryObject()
+        for key in ("/Root", "/Info", "/ID"):
+            if key in reader.trailer:
+                trailer[NameObject(key)] = reader.trailer.raw_get(key)
+
+        # PyPDF2 leaves /Size out of the trailers of cross-reference streams
+        numbers = [number for numbers in reader.xref.values() for number in numbers]
+        size = max([int(reader.trailer.get("/Size", 0))] + [number + 1 for number in chain(numbers, reader.xref_objStm)])
+
+        self._splice = {
+            "data": data,
+            "size": size,
+            "startxref": int(match.group(1)),
+            "page_ref": page_ref,
+            "page": page,
+            "resources": resources,
+            "xobjects": xobjects,
+            "contents": contents,
+            "pages_ref": pages_ref,
+            "pages": pages,
+            "trailer": trailer,
+            # Save the template's graphics state, then draw the overlay on top
+            "prefix": _stream(b"q\n"),
+            "suffix": _stream(f"\nQ q {OVERLAY_FORM_NAME} Do Q\n".encode()),
+        }
+        return self._splice
+
+    @property
+    def data(self):
+        """The template file's bytes, which spliced output files start with"""
+        return self._splice_base()["data"]
+
+    def check_splice(self):
+        """Raise ValueError if output files cannot be appended to the template"""
+        self._splice_base()
+
+    def splice(self, overlay_page):
+        """Return the incremental update that draws the overlay over the template's first page
+
+        Appended to the template's unchanged bytes it makes a valid PDF: the
+        overlay as a Form XObject, a new version of the page that draws it
+        and the page tree, then an xref section chained to the template's.
+        """
+        base = self._splice_base()
+        update = BytesIO()
+        writer = PdfUpdateWriter(update, base["size"], len(base["data"]))
+
+        # Turn the overlay's content stream into a Form XObject
+        overlay_contents = overlay_page.get("/Contents")
+        if overlay_contents is not None and isinstance(overlay_contents.get_object(), StreamObject):
+            form = overlay_contents.get_object()  # Kept encoded as reportlab wrote it
+        else:
+            form = _stream(_content_data(overlay_contents))
+        form[NameObject("/Type")] = NameObject("/XObject")
+        form[NameObject("/Subtype")] = NameObject("/Form")
+        form[NameObject("/BBox")] = overlay_page.mediabox
+        if "/Resources" in overlay_page:
+            form[NameObject("/Resources")] = overlay_page.raw_get("/Resources")
+        form = writer.add(form)
+
+        xobjects = DictionaryObject(base["xobjects"])
+        xobjects[NameObject(OVERLAY_FORM_NAME)] = form
+        resources = DictionaryObject(base["resources"])
+        resources[NameObject("/XObject")] = xobjects
+        page = DictionaryObject(base["page"])
+        page[NameObject("/Resources")] = resources
+        page[NameObject("/Contents")] = ArrayObject(
+            [writer.add(base["prefix"])] + base["contents"] + [writer.add(base["suffix"])]
+        )
+
+        page_ref, pages_ref = base["page_ref"], base["pages_ref"]
+        writer.replace(page_ref.idnum, page_ref.generation, page)
+        writer.replace(pages_ref.idnum, pages_ref.generation, base["pages"])
+        writer.close(base["trailer"], base["startxref"])
+        return update
+
+
+class TemplateCache:
+    """Keeps parsed templates in memory until the file's mtime or size changes"""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        entry = self._entries.get(path)
+        if entry is None or entry[0] != key:
+            entry = (key, Template(path, (path,) + key))
+            self._entries[path] = entry
+        return entry[1]
+
+
+_template_cache = TemplateCache()
+
+
+def load_template(path):
+    """Return the cached Template for path, re-parsing it only when the file changes"""
+    return _template_cache.get(path)
+
+
+class PageCache:
+    """Least recently used finished pages, bounded by their total size in bytes
+
+    Keys are digests of everything a page depends on, so rows whose
+    substituted text and formatting match reuse one rendering.
+    """
+
+    def __init__(self, max_bytes=PAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._pages = OrderedDict()
+
+    def get(self, key):
+        page = self._pages.get(key)
+        if page is not None:
+            self._pages.move_to_end(key)
+        return page
+
+    def put(self, key, page):
+        if len(page) > self.max_bytes or key in self._pages:
+            return
+        self._pages[key] = page
+        self.size += len(page)
+        while self.size > self.max_bytes:
+            key, page = self._pages.popitem(last=False)
+            self.size -= len(page)
+
+
+_page_cache = PageCache()
+
+
+class RenderJob:
+    """Settings for one batch; picklable so worker processes can receive it"""
+
+    def __init__(self, template_path, output_dir, filename_prefix, rich_text, font_name, font_size, x_percent, y_percent, max_chars, output_mode="files", merged_filename="merged.pdf", wrap_mode="chars", line_width="80", custom_fonts=None, archive="", archive_filename="", shard_by=""):
+        if not template_path or not output_dir or not rich_text.text:
+            raise ValueError("All fields are required!")
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {output_mode}")
+        if archive and archive not in ARCHIVE_FORMATS:
+            raise ValueError(f"Unknown archive format: {archive}")
+        if archive and output_mode == "merged":
+            raise ValueError("A single merged PDF cannot be written to an archive")
+        if wrap_mode not in WRAP_MODES:
+            raise ValueError(f"Unknown wrap mode: {wrap_mode}")
+
+        self.template_path = template_path
+        self.output_dir = output_dir
+        self.filename_prefix = filename_prefix
+        self.rich_text = rich_text
+        # custom_fonts maps family names to their TrueType files, as saved in the settings
+        self.font_name = font_name
+        self.font_files = (custom_fonts or {}).get(font_name)
+        self.fonts = font_family(font_name, self.font_files)
+        self.x = float(x_percent) / 100
+        self.y = float(y_percent) / 100
+        self.font_size = int(font_size)
+        self.max_chars = int(max_chars)
+        self.wrap_mode = wrap_mode
+        self.line_width = float(line_width) / 100  # Fraction of the page width
+        self.output_mode = output_mode
+        self.merged_filename = merged_filename
+        # "zip" or "tar" puts every row's PDF in one archive instead of loose files
+        self.archive = archive
+        self.archive_filename = archive_filename
+        # "hash" or a tag puts the per-row files in subdirectories
+        self.shard_by = shard_by
+        self.headers = None
+        self.text_plan = None
+        self.filename_plan = None
+        self.page_settings = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.metrics = None  # A metrics.Metrics while a run is being instrumented
+        self._directories = set()  # Subdirectories this process has made
+
+    def __setstate__(self, state):
+        # Worker processes register custom fonts when they receive the job
+        self.__dict__.update(state)
+        if self.font_files:
+            font_family(self.font_name, self.font_files)
+
+    def prepare(self, headers, warn=None):
+        """Compile the text and filename pattern against the CSV headers before any row
+
+        Filename tags missing from the headers raise ValueError; unknown text
+        tags are left as they are and reported once through warn.
+        """
+        self.headers = headers
+        self.text_plan = self.rich_text.compile(headers)
+        self.filename_plan = FilenamePlan(self.filename_prefix, headers, self.shard_by) if self.output_mode != "merged" else None
+        if self.text_plan.unknown_tags and warn is not None:
+            tags = ', '.join('{' + tag + '}' for tag in self.text_plan.unknown_tags)
+            warn(f"Tags not found in CSV headers, left as text: {tags}")
+
+        # Everything besides the row's text and the template file that a finished page depends on
+        self.page_settings = repr((
+            self.output_mode, self.fonts, self.font_size, self.x, self.y,
+            self.wrap_mode, self.max_chars, self.line_width,
+        ))
+
+    def font_for(self, formats):
+        base_font, bold_font, italic_font, bold_italic_font = self.fonts
+        if 'italic' in formats:
+            return bold_italic_font if 'bold' in formats else italic_font
+        if 'bold' in formats:
+            return bold_font
+        return base_font
+
+    def layout(self, runs):
+        """Join the runs and wrap them; returns the StyledText and each line's (start, end)"""
+        # Join the runs into one text with an index of where each style starts
+        styled = StyledText(runs)
+
+        # Wrap text according to max_chars, or to the line width measured in each run's font;
+        # lines come back as offsets into the text so styles are found without searching
+        if self.wrap_mode == "width":
+            measure = width_measure(styled.text, styled.font_ranges(self.font_for), self.font_size)
+            line_spans = wrap_spans(styled.text, self.line_width * letter[0], measure)
+        else:
+            line_spans = wrap_spans(styled.text, self.max_chars)
+        return styled, line_spans
+
+    def render_overlay(self, runs):
+        """Draw the formatted runs on a blank page and return the PDF as a BytesIO"""
+        return self.draw_overlay(*self.layout(runs))
+
+    def placed_lines(self, styled, line_spans):
+        """Yield each line as (y, [(x, text, font name, width, formats)]) in PDF points
+
+        Empty lines have no pieces and only move the next line down.
+        """
+        # Imported with the first row, so runs that render nothing start faster
+        from reportlab.pdfbase import pdfmetrics
+        font_size = self.font_size
+
+        # Calculate position
+        line_height = font_size * 1.2
+        y_start = self.y * letter[1]
+        y_pos = letter[1] - y_start
+        x_offset = self.x * letter[0]
+
+        for start, end in line_spans:
+            pieces = []
+            if styled.text[start:end].strip():  # Handle empty lines
+                x_pos = x_offset
+                for segment, formats in styled.segments(start, end):
+                    current_font = self.font_for(formats)
+                    width = pdfmetrics.stringWidth(segment, current_font, font_size)
+                    pieces.append((x_pos, segment, current_font, width, formats))
+                    x_pos += width
+            yield y_pos, pieces
+            y_pos -= line_height
+
+    def draw_overlay(self, styled, line_spans):
+        """Draw laid out lines on a blank page and return the PDF as a BytesIO
+
+        All the text goes into one text object that switches font only where
+        the style changes, and all the underlines into one path.
+        """
+        from reportlab.pdfgen import canvas
+        font_size = self.font_size
+
+        packet = BytesIO()
+        c = canvas.Canvas(packet, pagesize=letter)
+        text = c.beginText()
+        underlines = None
+        current_font = None
+
+        # Draw text line by line, placing each piece where layout measured it
+        for y_pos, pieces in self.placed_lines(styled, line_spans):
+            if pieces:
+                # textOut moves on by each piece's width, so a line needs one origin
+                text.setTextOrigin(pieces[0][0], y_pos)
+            for x_pos, segment, font_name, width, formats in pieces:
+                # Apply font formatting
+                if font_name != current_font:
+                    text.setFont(font_name, font_size)
+                    current_font = font_name
+                text.textOut(segment)
+
+                # Collect underlines to stroke together
+                if 'underline' in formats:
+                    if underlines is None:
+                        underlines = c.beginPath()
+                    y_underline = y_pos - 1.5
+                    underlines.moveTo(x_pos, y_underline)
+                    underlines.lineTo(x_pos + width, y_underline)
+
+        if current_font is not None:
+            c.drawText(text)
+        if underlines is not None:
+            c.setLineWidth(0.5)
+            c.drawPath(underlines, stroke=1, fill=0)
+        c.save()
+        packet.seek(0)
+        return packet
+
+    def substitute(self, row):
+        """Return the row's text as (text, formats) runs"""
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter()
+        try:
+            # Substitute tags and resolve formatting without touching Tk
+            runs = self.text_plan.runs(row)
+        except KeyError as e:
+            raise ValueError(f"Tag '{e.args[0]}' not found in CSV headers: {self.headers}")
+        if metrics is not None:
+            metrics.lap("substitute", started)
+        return runs
+
+    def render_runs(self, runs):
+        """Lay out and draw the runs; returns the overlay as PDF bytes"""
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter()
+
+        styled, line_spans = self.layout(runs)
+        if metrics is not None:
+            started = metrics.lap("layout", started)
+
+        overlay = self.draw_overlay(styled, line_spans).getvalue()
+        if metrics is not None:
+            metrics.lap("draw", started)
+        return overlay
+
+    def build_page(self, runs):
+        """Return the finished bytes for the runs, rendering them only on a cache miss
+
+        That is the overlay in merged mode, the update to append to the
+        template in spliced mode and the whole PDF in files mode.
+        """
+        # The template is looked up per row, so a long running process sees it change
+        template = load_template(self.template_path)
+        key = hashlib.sha256(repr((self.page_settings, template.version, runs)).encode("utf-8")).digest()
+        page = _page_cache.get(key)
+        if page is not None:
+            self.cache_hits += 1
+            if self.metrics is not None:
+                self.metrics.count("cache_hits")
+            return page
+        self.cache_misses += 1
+        if self.metrics is not None:
+            self.metrics.count("cache_misses")
+
+        overlay_bytes = self.render_runs(runs)
+        if self.output_mode == "merged":
+            _page_cache.put(key, overlay_bytes)
+            return overlay_bytes
+
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter()
+
+        # Draw the overlay on top of the cached template page
+        overlay = PdfReader(BytesIO(overlay_bytes))
+        if self.output_mode == "spliced":
+            # The template's bytes are written as they are, followed by the update
+            page = template.splice(overlay.pages[0]).getvalue()
+        else:
+            # Create output PDF
+            output_pdf = PdfWriter()
+            output_pdf.add_page(template.merge(overlay.pages[0]))
+            document = BytesIO()
+            output_pdf.write(document)
+            page = document.getvalue()
+        if metrics is not None:
+            metrics.lap("merge", started)
+        _page_cache.put(key, page)
+        return page
+
+    def write_row(self, row, number=None):
+        """Render row number number, write it to its planned file and return (size, tail digest) for the manifest
+
+        With an archive nothing is written here; (filename, PDF bytes) is
+        returned for the archive's writer thread instead, without the
+        template's bytes in spliced mode.
+        """
+        filename = self.filename_plan.path(number, row)
+        page = self.build_page(self.substitute(row))
+        if self.archive:
+            return filename, page
+
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter()
+
+        path = os.path.join(self.output_dir, filename)
+        if self.filename_plan.shard_by:
+            directory = os.path.dirname(path)
+            if directory not in self._directories:
+                os.makedirs(directory, exist_ok=True)
+                self._directories.add(directory)
+
+        # Write the output file
+        prefix = load_template(self.template_path).data if self.output_mode == "spliced" else b""
+        with open(path, "wb") as out_file:
+            out_file.write(prefix)
+            out_file.write(page)
+        size = len(prefix) + len(page)
+        if metrics is not None:
+            metrics.lap("write", started)
+            metrics.count("bytes_written", size)
+        return size, tail_digest(prefix, page)
+
+    def render_document(self, row):
+        """Render one row and return its whole PDF as bytes, without writing anything"""
+        if self.output_mode == "merged":
+            raise ValueError("Single documents are rendered in files or spliced mode, not merged")
+        page = self.build_page(self.substitute(row))
+        if self.output_mode == "spliced":
+            return load_template(self.template_path).data + page
+        return page
+
+    def process_row(self, row, number=None):
+        """Do a row's share of the work that can run in a worker process
+
+        In files and spliced mode the row's PDF is written and its size and
+        tail digest returned, or handed back for the archive; in merged mode the overlay
+        bytes are returned for open_output()'s writer.
+        """
+        try:
+            if self.output_mode == "merged":
+                result = self.build_page(self.substitute(row))
+            else:
+                result = self.write_row(row, number)
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.count("failures")
+            raise
+        if self.metrics is not None:
+            self.metrics.count("rows")
+        return result
+
+    def open_output(self):
+        """Return the writer that collects process_row() results, if the mode needs one"""
+        if self.output_mode == "merged":
+            path = os.path.join(self.output_dir, self.merged_filename or "merged.pdf")
+            return MergedOutput(path, load_template(self.template_path), self.metrics)
+        if self.archive:
+            path = os.path.join(self.output_dir, archive_filename(self.archive, self.archive_filename))
+            prefix = load_template(self.template_path).data if self.output_mode == "spliced" else b""
+            return ArchiveWriter(path, self.archive, prefix, self.metrics)
+        return None
+
+
+class MergedOutput:
+    """Streams every row as a page of one PDF that holds the template's objects once"""
+
+    def __init__(self, path, template, metrics=None):
+        self.path = path
+        self.template = template
+        self.metrics = metrics
+        self.writer = StreamingPdfWriter(path)
+        self.writer.share(template.form, source=template.reader)
+        self.writer.share(template.prefix)
+
+    def add(self, overlay_bytes):
+        if self.metrics is not None:
+            started = time.perf_counter()
+        overlay = PdfReader(BytesIO(overlay_bytes))
+        page = self.template.merge(overlay.pages[0])
+        if self.metrics is not None:
+            started = self.metrics.lap("merge", started)
+        self.writer.add_page(page)
+        if self.metrics is not None:
+            self.metrics.lap("write", started)
+
+    def close(self):
+        self.writer.close()
+        if self.metrics is not None:
+            self.metrics.count("bytes_written", os.path.getsize(self.path))
+
+
+def resolve_workers(workers):
+    """Turn the workers setting into a process count; 0 or empty means one per core"""
+    workers = int(workers or 0)
+    if workers < 0:
+        raise ValueError("Worker processes must be 0 or more")
+    return workers or os.cpu_count() or 1
+
+
+def count_rows(csv_path, selection=None, query=""):
+    """Count the data rows of an input file, or those a selection matches, without rendering them
+
+    Returns None for inputs that can only be read as a stream, such as
+    compressed files, rather than reading them through an extra time.
+    """
+    source = open_source(csv_path, query)
+    if source.splittable:
+        if selection:
+            return len(select_rows(CsvIndex(csv_path), selection))
+        with open(csv_path, mode="r", encoding='utf-8-sig', newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)  # Skip the header row
+            return sum(1 for row in reader if row)
+    if not selection and isinstance(source, SqliteSource):
+        return source.count()
+    return None
+
+
+def generate_documents(job, csv_path, workers=1, chunk_size=DEFAULT_CHUNK_SIZE, progress=None, cancel_event=None, warn=None, metrics=None, manifest=None, selection=None, query=""):
+    """Render every row of an input file, serially or in a process pool; returns the row count
+
+    csv_path is a CSV file or any other input sources.open_source() reads,
+    such as a gzip compressed CSV, JSON Lines or a SQLite database queried
+    with query. progress is called with the number of rows done so far,
+    and setting cancel_event stops the run once the rows already being
+    rendered finish. warn receives problems found before the run that do
+    not stop it. metrics, a metrics.Metrics, collects per-stage timings and
+    counters from this process and every worker. With a manifest.Manifest,
+    rows whose file is still current are skipped (and counted as done) and
+    every file written is recorded; it is ignored in merged mode and when
+    writing an archive. selection, e.g. "51200-51250" or "city=Madrid",
+    renders only the matching rows.
+    """
+    if not csv_path:
+        raise ValueError("All fields are required!")
+    job.metrics = metrics
+    job.cache_hits = job.cache_misses = 0
+    if job.output_mode == "merged" or job.archive:
+        manifest = None
+
+    # Parse the template up front so a broken file fails before any row;
+    # spliced mode also checks that the file can be appended to
+    template = load_template(job.template_path)
+    if job.output_mode == "spliced":
+        template.check_splice()
+
+    source = open_source(csv_path, query)
+    index = None
+    output = None
+    executor = None
+    try:
+        if not source.splittable:
+            # Rows are read here as they arrive and planned on the way
+            job.prepare(source.headers, warn)
+            rows = _source_rows(job, source, selection, warn)
+            tasks = None
+            if workers > 1:
+                tasks = _row_batches(job, rows, chunk_size)
+        elif selection:
+            # Read only the selected rows, found through the CSV's row index
+            index = CsvIndex(csv_path)
+            job.prepare(index.headers, warn)
+            numbers = select_rows(index, selection)
+            tasks = [(csv_path, spans, group, None) for spans, group in _group_rows(index, numbers, chunk_size)]
+        else:
+            headers, data_start = read_csv_header(csv_path)
+            job.prepare(headers, warn)
+            # In parallel mode workers parse their own byte ranges of about
+            # chunk_size rows; serially the whole file is read in order
+            tasks = None
+            if workers > 1:
+                tasks = [(csv_path, [span], None, None) for span in split_csv(csv_path, data_start, chunk_size)]
+
+        if manifest is not None:
+            manifest.begin(job)
+        if workers > 1:
+            executor = _start_pool(job, manifest, workers)
+        if source.splittable:
+            if job.filename_plan is not None:
+                if selection:
+                    tasks = _plan_selection(job, csv_path, index, tasks, executor, chunk_size)
+                else:
+                    tasks = _plan_filenames(job, csv_path, tasks, executor)
+                _warn_renames(job.filename_plan, warn)
+            if tasks is None:
+                rows = _csv_rows(csv_path)
+        output = job.open_output()
+
+        if executor is not None:
+            count = _generate_parallel(job, tasks, executor, workers, progress, cancel_event, output, manifest)
+        elif tasks is None:
+            count = _generate_serial(job, rows, progress, cancel_event, output, manifest)
+        else:
+            rows = chain.from_iterable(_task_rows(job, task) for task in tasks)
+            count = _generate_serial(job, rows, progress, cancel_event, output, manifest)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if output is not None:
+            output.close()
+        if manifest is not None:
+            manifest.close()
+
+    if manifest is not None and manifest.skipped:
+        count += manifest.skipped
+        if progress is not None:
+            progress(count)
+    return count
+
+
+def _group_rows(index, numbers, rows_per_group):
+    """Yield (byte spans, row numbers) for groups of rows_per_group of the given rows"""
+    for first in range(0, len(numbers), rows_per_group):
+        group = numbers[first:first + rows_per_group]
+        yield [(start, end) for start, end, size in index.spans(group)], group
+
+
+def _csv_rows(csv_path):
+    # The whole file in order, numbered as the row index numbers rows
+    with open(csv_path, mode="r", encoding='utf-8-sig', newline='') as csvfile:  # utf-8-sig handles BOM character
+        yield from enumerate(csv.DictReader(csvfile), 1)
+
+
+def _task_rows(job, task):
+    """Yield (row number, row) for the rows of a task; numbers are None where not known
+
+    A task is (csv_path, byte spans, row numbers, renames), or (None, rows,
+    row numbers, renames) for rows this process read from a source that
+    cannot be split. renames holds the planned paths of renamed rows that
+    workers were not given when they started.
+    """
+    csv_path, spans, numbers, renames = task
+    if csv_path is None:
+        rows = spans
+    else:
+        rows = chain.from_iterable(read_csv_range(csv_path, start, end, job.headers) for start, end in spans)
+    return zip(numbers if numbers is not None else repeat(None), rows)
+
+
+def _source_rows(job, source, selection, warn):
+    """Yield (row number, row) for the selected rows of a source, planning filenames on the way
+
+    Names are planned in row order as with a CSV, so the first row keeps a
+    contested name; renamed rows are reported once the source is read.
+    """
+    plan = job.filename_plan
+    matches = row_filter(selection, source.headers) if selection else None
+    for number, row in enumerate(source.rows(), 1):
+        if plan is not None:
+            plan.add(number, plan.base_path(row))
+        if matches is None or matches(number, row):
+            yield number, row
+    if plan is not None:
+        plan.finish()
+        _warn_renames(plan, warn)
+
+
+def _row_batches(job, rows, rows_per_batch):
+    """Group (number, row) pairs into tasks for worker processes"""
+    renames = job.filename_plan.renames if job.filename_plan is not None else {}
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, rows_per_batch))
+        if not batch:
+            return
+        numbers = [number for number, row in batch]
+        yield (None, [row for number, row in batch], numbers,
+               {number: renames[number] for number in numbers if number in renames})
+
+
+def _task_paths(job, task):
+    return [job.filename_plan.base_path(row) for number, row in _task_rows(job, task)]
+
+
+def _range_paths(task):
+    """Return the base path of every row of a task, in a worker process"""
+    return _task_paths(_worker_job, task)
+
+
+def _with_renames(plan, tasks):
+    # Workers started before the plan existed, so each task carries its rows' renames
+    renames = plan.renames
+    return [(path, spans, numbers, {number: renames[number] for number in numbers if number in renames})
+            for path, spans, numbers, _ in tasks]
+
+
+def _plan_filenames(job, csv_path, tasks, executor):
+    """Expand every row's output path before rendering and return the tasks with row numbers
+
+    tasks are byte ranges covering the whole CSV in order, or None to read
+    it here. In parallel mode the workers expand the names of their own
+    ranges and only collisions are resolved here. The renames are saved
+    beside the CSV for later runs that render a selection.
+    """
+    plan = job.filename_plan
+    saved = SavedRenames(csv_path, job.filename_prefix, job.shard_by)
+    if tasks is None:
+        for number, row in _csv_rows(csv_path):
+            plan.add(number, plan.base_path(row))
+    else:
+        if executor is not None:
+            expanded = executor.map(_range_paths, tasks)
+        else:
+            expanded = (_task_paths(job, task) for task in tasks)
+        # Number the byte ranges' rows as their names come back
+        numbered = []
+        number = 0
+        for task, paths in zip(tasks, expanded):
+            first = number + 1
+            for number, path in enumerate(paths, first):
+                plan.add(number, path)
+            numbered.append((task[0], task[1], range(first, number + 1), None))
+        tasks = _with_renames(plan, numbered)
+    plan.finish()
+    saved.save(plan)
+    return tasks
+
+
+def _plan_selection(job, csv_path, index, tasks, executor, chunk_size):
+    """Give the selected rows of tasks the paths a run over the whole CSV would give them
+
+    Only the selected rows are looked up: with no tags in the pattern row n
+    is simply copy n of the one name, and otherwise the renames come from
+    the plan saved by the last run over the CSV. Without one the whole CSV
+    is planned once, in parallel when there is a worker pool.
+    """
+    plan = job.filename_plan
+    numbers = [number for task in tasks for number in task[2]]
+    if not plan.tags:
+        plan.add_untagged(numbers, index.row_count)
+        return _with_renames(plan, tasks)
+
+    saved = SavedRenames(csv_path, job.filename_prefix, job.shard_by)
+    if saved.load():
+        plan.renames = saved.renames(numbers)
+        plan.renamed = saved.count
+        plan.example = saved.example
+    else:
+        every_row = [(csv_path, spans, group, None) for spans, group in _group_rows(index, range(1, index.row_count + 1), chunk_size)]
+        _plan_filenames(job, csv_path, every_row, executor)
+    return _with_renames(plan, tasks)
+
+
+def _warn_renames(plan, warn):
+    if plan.renamed and warn is not None:
+        warn(f"{plan.renamed} rows would have overwritten another row's file and were renamed, e.g. {plan.example}")
+
+
+def _changed_rows(job, rows, manifest):
+    """Yield (number, row, (filename, digest)) for rows the manifest does not have current output for
+
+    rows are (number, row) pairs. Without a manifest every row is yielded,
+    with None in place of the key.
+    """
+    for number, row in rows:
+        if manifest is None:
+            yield number, row, None
+            continue
+        filename = job.filename_plan.path(number, row)
+        digest = manifest.digest(row)
+        if manifest.is_current(filename, digest):
+            manifest.skipped += 1
+        else:
+            yield number, row, (filename, digest)
+
+
+def _generate_serial(job, rows, progress, cancel_event, output, manifest):
+    count = 0
+    for number, row, key in _changed_rows(job, rows, manifest):
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        result = job.process_row(row, number)
+        if output is not None:
+            output.add(result)
+        if key is not None:
+            manifest.record(*key, result)
+        count += 1
+        if progress is not None:
+            progress(count + manifest.skipped if manifest is not None else count)
+    return count
+
+
+# Job and manifest of the current worker process, set once by the pool initializer
+_worker_job = None
+_worker_manifest = None
+
+
+def _init_worker(job, manifest):
+    global _worker_job, _worker_manifest
+    _worker_job = job
+    _worker_manifest = manifest
+    if job.metrics is not None:
+        # Measure only this worker's rows; they are sent back with each range
+        job.metrics = Metrics()
+    # Warm the per-process template cache before the first range arrives
+    load_template(job.template_path)
+
+
+def _render_range(task):
+    """Parse and render byte ranges of the CSV
+
+    Returns the (key, result) of each rendered row, the number of rows the
+    manifest skipped, the metrics gathered since the last range and the
+    page cache's (hits, misses) for the range.
+    """
+    job = _worker_job
+    manifest = _worker_manifest
+    skipped = manifest.skipped if manifest is not None else 0
+
+    renames = task[3]
+    if renames:
+        job.filename_plan.renames.update(renames)
+    rows = _task_rows(job, task)
+    results = [(key, job.process_row(row, number)) for number, row, key in _changed_rows(job, rows, manifest)]
+    if manifest is not None:
+        skipped = manifest.skipped - skipped
+
+    metrics = job.metrics
+    if metrics is not None:
+        job.metrics = Metrics()
+    cache = (job.cache_hits, job.cache_misses)
+    job.cache_hits = job.cache_misses = 0
+    return results, skipped, metrics, cache
+
+
+def _start_pool(job, manifest, workers):
+    # spawn keeps Tk and any GUI threads out of the workers
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(job, manifest))
+
+
+def _generate_parallel(job, tasks, executor, workers, progress, cancel_event, output, manifest):
+    count = 0
+    skipped = 0
+    # Results are consumed in submission order so the first failing row
+    # is reported exactly as the serial path would report it
+    pending = deque()
+
+    def collect():
+        nonlocal count, skipped
+        try:
+            results, range_skipped, worker_metrics, (hits, misses) = pending.popleft().result()
+        except Exception:
+            # The worker's own count is lost with its range
+            if job.metrics is not None:
+                job.metrics.count("failures")
+            raise
+        if worker_metrics is not None:
+            job.metrics.merge(worker_metrics)
+        job.cache_hits += hits
+        job.cache_misses += misses
+        for key, result in results:
+            if output is not None:
+                output.add(result)
+            if key is not None:
+                manifest.record(*key, result)
+        count += len(results)
+        skipped += range_skipped
+        if progress is not None:
+            progress(count + skipped)
+
+    try:
+        for task in tasks:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            pending.append(executor.submit(_render_range, task))
+            if len(pending) >= workers * 2:
+                collect()
+        while pending:
+            if cancel_event is not None and cancel_event.is_set():
+                # Drop ranges that have not started; running ones still finish
+                for future in pending:
+                    future.cancel()
+                pending = deque(future for future in pending if not future.cancelled())
+                if not pending:
+                    break
+            collect()
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+    finally:
+        if manifest is not None:
+            manifest.skipped += skipped
+    return count
@@ -0,0 +1,179 @@
+import re
+from bisect import bisect_right
+
+
+FORMAT_TAGS = ("bold", "italic", "underline")
+
+PLACEHOLDER_RE = re.compile(r'\{([^{}]+)\}')
+
+ESCAPE_RE = re.compile(r'\\([ntr])')
+ESCAPES = {'n': '\n', 't': '    ', 'r': '\r'}
+
+# Markup used for formatting where there is no editor widget
+MARKUP_RE = re.compile(r'<(/?)(b|i|u)>')
+MARKUP_TAGS = {"b": "bold", "i": "italic", "u": "underline"}
+
+
+def process_escape_sequences(text):
+    # One left-to-right pass: \n is a new line, \t four spaces and \r a carriage return
+    if '\\' not in text:
+        return text
+    return ESCAPE_RE.sub(lambda match: ESCAPES[match.group(1)], text)
+
+
+class RichText:
+    """Plain text plus bold/italic/underline spans, independent of any Tk widget"""
+
+    def __init__(self, text, format_ranges=None):
+        # format_ranges maps a format tag to a list of (start, end) character offsets
+        self.text = text
+        self.spans = self._build_spans(text, format_ranges or {})
+        self._span_starts = [start for start, end, formats in self.spans]
+
+    @staticmethod
+    def _build_spans(text, format_ranges):
+        # Cut the text at every range boundary so each span has a single set of formats
+        length = len(text)
+        clamped = {}
+        boundaries = {0, length}
+        for tag in FORMAT_TAGS:
+            ranges = []
+            for start, end in format_ranges.get(tag, ()):
+                start, end = max(0, min(start, length)), max(0, min(end, length))
+                if start < end:
+                    ranges.append((start, end))
+                    boundaries.update((start, end))
+            clamped[tag] = ranges
+
+        points = sorted(boundaries)
+        spans = []
+        for start, end in zip(points, points[1:]):
+            formats = tuple(
+                tag for tag in FORMAT_TAGS
+                if any(s <= start and end <= e for s, e in clamped[tag])
+            )
+            if spans and spans[-1][2] == formats:
+                spans[-1] = (spans[-1][0], end, formats)
+            else:
+                spans.append((start, end, formats))
+        return spans
+
+    def formats_at(self, offset):
+        """Return the formats active at a character offset of the source text"""
+        if not self.spans:
+            return ()
+        index = bisect_right(self._span_starts, offset) - 1
+        return self.spans[max(index, 0)][2]
+
+    def ranges(self, tag):
+        """Return the (start, end) offsets formatted with tag, neighbouring spans joined"""
+        ranges = []
+        for start, end, formats in self.spans:
+            if tag not in formats:
+                continue
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        return ranges
+
+    def compile(self, headers):
+        """Compile the text against the CSV headers into a CompiledText"""
+        return CompiledText(self, headers)
+
+    def _add_literal(self, pieces, start, end):
+        # Append the source text between start and end split at span boundaries
+        if start >= end:
+            return
+        index = max(bisect_right(self._span_starts, start) - 1, 0)
+        while start < end and index < len(self.spans):
+            span_start, span_end, formats = self.spans[index]
+            stop = min(end, span_end)
+            pieces.append((self.text[start:stop], formats))
+            start = stop
+            index += 1
+
+
+class CompiledText:
+    """RichText split once into literal runs and tag slots for fast per-row substitution"""
+
+    def __init__(self, rich_text, headers):
+        known = set(headers or ())
+        self.unknown_tags = []
+
+        pieces = []  # (literal text or None, tag or None, formats)
+        literals = []
+        pos = 0
+        for match in PLACEHOLDER_RE.finditer(rich_text.text):
+            key = match.group(1)
+            if key not in known:
+                # Unknown tags stay in the text untouched
+                if key not in self.unknown_tags:
+                    self.unknown_tags.append(key)
+                continue
+            rich_text._add_literal(literals, pos, match.start())
+            pieces.extend((text, None, formats) for text, formats in literals)
+            literals.clear()
+            # A substituted value takes the formatting of its tag
+            pieces.append((None, key, rich_text.formats_at(match.start())))
+            pos = match.end()
+        rich_text._add_literal(literals, pos, len(rich_text.text))
+        pieces.extend((text, None, formats) for text, formats in literals)
+
+        # Merge neighbouring literals and resolve their escapes now, so rows
+        # only pay for the values they substitute
+        self.parts = []
+        for text, key, formats in pieces:
+            if key is None and self.parts and self.parts[-1][1] is None and self.parts[-1][2] == formats:
+                self.parts[-1] = (self.parts[-1][0] + text, None, formats)
+            else:
+                self.parts.append((text, key, formats))
+        self.parts = [
+            (process_escape_sequences(text) if key is None else None, key, formats)
+            for text, key, formats in self.parts
+        ]
+        self.tags = [key for text, key, formats in self.parts if key is not None]
+
+    def runs(self, row):
+        """Return the (text, formats) runs of the text with row's values substituted"""
+        runs = []
+        for text, key, formats in self.parts:
+            if key is not None:
+                text = str(row[key])
+                if '\\' in text:
+                    text = process_escape_sequences(text)
+            if not text:
+                continue
+            if runs and runs[-1][1] == formats:
+                runs[-1] = (runs[-1][0] + text, formats)
+            else:
+                runs.append((text, formats))
+        return runs
+
+
+def parse_markup(markup):
+    """Build a RichText from text using <b>, <i> and <u> tags for formatting"""
+    parts = []
+    format_ranges = {tag: [] for tag in FORMAT_TAGS}
+    open_at = {}
+    length = 0
+    pos = 0
+    for match in MARKUP_RE.finditer(markup):
+        parts.append(markup[pos:match.start()])
+        length += match.start() - pos
+        pos = match.end()
+
+        tag = MARKUP_TAGS[match.group(2)]
+        if match.group(1):
+            start = open_at.pop(tag, None)
+            if start is not None:
+                format_ranges[tag].append((start, length))
+        elif tag not in open_at:
+            open_at[tag] = length
+    parts.append(markup[pos:])
+    length += len(markup) - pos
+
+    # Tags left open run to the end of the text
+    for tag, start in open_at.items():
+        format_ranges[tag].append((start, length))
+    return RichText(''.join(parts), format_ranges)
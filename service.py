@@ -0,0 +1,342 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import stat
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from string import Formatter
+from urllib.parse import quote
+from metrics import Metrics
+from richtext import PLACEHOLDER_RE
+from sources import text_value
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# Requests waiting for a free worker before new ones are turned away with 503
+DEFAULT_MAX_PENDING = 64
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = 1024 * 1024
+
+# Seconds a client has to send a request, and may keep an idle connection open
+REQUEST_TIMEOUT = 30
+
+HTTP_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Content Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+# Methods each path answers
+ROUTES = {"/render": "POST", "/health": "GET", "/metrics": "GET"}
+
+
+class RequestError(Exception):
+    """A request the service refuses, with the HTTP status to answer it with"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def request_fields(job):
+    """Return the fields a request supplies: every tag of the text and of the filename pattern, in order"""
+    tags = [match.group(1) for match in PLACEHOLDER_RE.finditer(job.rich_text.text)]
+    tags += [tag for literal, tag, spec, conversion in Formatter().parse(job.filename_prefix.strip()) if tag]
+    return list(dict.fromkeys(tags))
+
+
+# Job of the current worker process, set once by the pool initializer
+_worker_job = None
+
+
+def _init_worker(job):
+    global _worker_job
+    _worker_job = job
+    # Parse the template, load the fonts and draw once before the first request
+    job.render_document(dict.fromkeys(job.headers, ""))
+    job.metrics = Metrics()
+
+
+def _worker_ready():
+    return os.getpid()
+
+
+def _render_request(row):
+    """Render one request's row; returns the PDF, its filename and the metrics gathered since the last request"""
+    job = _worker_job
+    document = job.render_document(row)
+    filename = job.filename_plan.pattern.format(row)
+    metrics = job.metrics
+    job.metrics = Metrics()
+    return document, filename, metrics
+
+
+class RenderService:
+    """Renders one PDF per request in a pool of worker processes kept warm
+
+    Every worker holds the prepared job, with the template parsed, the text
+    compiled, the fonts loaded and its own page cache, for as long as the
+    service runs. At most max_concurrent requests render at once, by default
+    one per worker; up to max_pending more wait for a free slot and any
+    beyond that are answered with 503 straight away.
+    """
+
+    def __init__(self, job, workers=1, max_concurrent=0, max_pending=DEFAULT_MAX_PENDING):
+        if job.output_mode == "merged":
+            raise ValueError("The service renders one PDF per request; use files or spliced output mode")
+        self.job = job
+        self.workers = workers
+        self.max_concurrent = max_concurrent or workers
+        self.max_pending = max_pending
+        self.fields = request_fields(job)
+        # Checks the filename pattern before any worker starts
+        job.prepare(self.fields)
+        self.metrics = Metrics()
+        self._slots = None
+        self._waiting = 0
+        self._executor = None
+        self._handlers = set()
+        self._idle = set()  # Writers of connections waiting for their next request
+        self._stopping = False
+
+    def _start_pool(self):
+        # spawn keeps the event loop and its sockets out of the workers
+        context = multiprocessing.get_context("spawn")
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=_init_worker, initargs=(self.job,))
+
+    async def start(self):
+        """Start the worker processes and wait until they are ready"""
+        self._start_pool()
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self._executor, _worker_ready) for _ in range(self.workers)))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+        self.metrics.finish()
+
+    async def render(self, values):
+        """Render the PDF for a dict of field values; returns (PDF bytes, filename, seconds queued, seconds rendering)"""
+        missing = [field for field in self.fields if field not in values]
+        if missing:
+            raise RequestError(400, f"Missing fields: {', '.join(missing)}")
+        row = {field: text_value(values[field]) for field in self.fields}
+
+        if self._slots.locked() and self._waiting >= self.max_pending:
+            self.metrics.count("rejected")
+            raise RequestError(503, "Too many requests waiting; try again shortly")
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        executor = self._executor
+        try:
+            queued = self.metrics.lap("queue", started)
+            loop = asyncio.get_running_loop()
+            document, filename, worker_metrics = await loop.run_in_executor(executor, _render_request, row)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for memory; later requests get a new pool
+            if executor is self._executor:
+                executor.shutdown(wait=False)
+                self._start_pool()
+            self.metrics.count("failures")
+            raise RequestError(503, "A worker stopped while rendering; try again")
+        finally:
+            self._slots.release()
+        rendered = self.metrics.lap("render", queued)
+        self.metrics.merge(worker_metrics)
+        self.metrics.count("rows")
+        return document, filename, queued - started, rendered - queued
+
+    async def respond(self, method, path, body):
+        """Answer one request; returns (status, content type, body, extra headers)"""
+        allowed = ROUTES.get(path)
+        if allowed is None:
+            raise RequestError(404, f"Unknown path: {path}")
+        if method != allowed:
+            return 405, "text/plain; charset=utf-8", f"{path} only accepts {allowed}\n".encode(), [("Allow", allowed)]
+
+        if path == "/health":
+            return 200, "application/json", json.dumps({"status": "ok", "workers": self.workers}).encode(), []
+        if path == "/metrics":
+            return 200, "text/plain; version=0.0.4", self.metrics.to_prometheus().encode(), []
+
+        try:
+            values = json.loads(body)
+        except ValueError as e:
+            raise RequestError(400, f"Body is not valid JSON: {e}")
+        if not isinstance(values, dict):
+            raise RequestError(400, "Body must be a JSON object of field values")
+        document, filename, queued, rendering = await self.render(values)
+        ascii_name = filename.encode("ascii", "replace").decode().replace('"', "_").replace("?", "_")
+        headers = [
+            ("Content-Disposition", f"inline; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"),
+            # Shown by browser developer tools; also handy for scripted clients
+            ("Server-Timing", f"queue;dur={queued * 1000:.1f}, render;dur={rendering * 1000:.1f}"),
+        ]
+        return 200, "application/pdf", document, headers
+
+    async def handle_connection(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection until the client closes it or asks to"""
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while not self._stopping:
+                self._idle.add(writer)
+                try:
+                    request = await asyncio.wait_for(read_request(reader, writer), REQUEST_TIMEOUT)
+                except RequestError as e:
+                    await write_response(writer, e.status, "text/plain; charset=utf-8", f"{e}\n".encode(), [], False)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                finally:
+                    self._idle.discard(writer)
+                if request is None:
+                    break
+
+                method, path, keep_alive, body = request
+                started = time.perf_counter()
+                self.metrics.count("requests")
+                try:
+                    status, content_type, body, headers = await self.respond(method, path, body)
+                except RequestError as e:
+                    status, content_type, body, headers = e.status, "text/plain; charset=utf-8", f"{e}\n".encode(), []
+                except Exception as e:
+                    self.metrics.count("failures")
+                    status, content_type, body, headers = 500, "text/plain; charset=utf-8", f"{e}\n".encode(), []
+                self.metrics.lap("request", started)
+                print(f"{method} {path} {status} {(time.perf_counter() - started) * 1000:.1f} ms", file=sys.stderr)
+                keep_alive = keep_alive and not self._stopping
+                await write_response(writer, status, content_type, body, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def drain(self):
+        """Close idle connections and wait for the requests being answered; later responses close their connection"""
+        self._stopping = True
+        for writer in self._idle:
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+
+async def read_request(reader, writer):
+    """Read one request; returns (method, path, keep alive, body), or None once the client has closed the connection"""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError as e:
+        if not e.partial.strip():
+            return None
+        raise
+    except asyncio.LimitOverrunError:
+        raise RequestError(400, "Request headers are too large")
+
+    lines = head.decode("latin-1").split("\r\n")
+    try:
+        method, target, version = lines[0].split(" ")
+    except ValueError:
+        raise RequestError(400, "Malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, separator, value = line.partition(":")
+        if not separator:
+            raise RequestError(400, "Malformed header line")
+        headers[name.strip().lower()] = value.strip()
+
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    if "transfer-encoding" in headers:
+        raise RequestError(411, "Send the body with a Content-Length")
+    length = headers.get("content-length", "0")
+    if not length.isdigit():
+        raise RequestError(400, "Invalid Content-Length")
+    length = int(length)
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, f"Bodies are limited to {MAX_BODY_BYTES} bytes")
+    if length and headers.get("expect", "").lower() == "100-continue":
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], keep_alive, body
+
+
+async def write_response(writer, status, content_type, body, headers, keep_alive):
+    lines = [
+        f"HTTP/1.1 {status} {HTTP_REASONS[status]}",
+        f"Content-Type: {content_type}",
+        f"Content-Length: {len(body)}",
+        f"Connection: {'keep-alive' if keep_alive else 'close'}",
+    ]
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+    writer.write(body)
+    await writer.drain()
+
+
+async def serve(service, socket_path="", host=DEFAULT_HOST, port=DEFAULT_PORT, ready=None):
+    """Run the service until SIGINT or SIGTERM, on a Unix socket when socket_path is set or else on host:port
+
+    ready, if given, is called with the address once requests are accepted.
+    """
+    if socket_path and os.path.exists(socket_path):
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            raise ValueError(f"{socket_path} exists and is not a socket")
+        os.remove(socket_path)  # Left behind by a service that did not stop cleanly
+
+    await service.start()
+    try:
+        if socket_path:
+            # Only this user may connect
+            umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(service.handle_connection, socket_path)
+            finally:
+                os.umask(umask)
+            address = socket_path
+        else:
+            server = await asyncio.start_server(service.handle_connection, host, port)
+            address = "http://{}:{}".format(*server.sockets[0].getsockname()[:2])
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows stops on KeyboardInterrupt instead
+        async with server:
+            if ready is not None:
+                ready(address)
+            await stop.wait()
+            server.close()
+            await service.drain()
+    finally:
+        service.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,122 @@
+import os
+import json
+import tempfile
+import threading
+
+
+SETTINGS_FILE = "settings.json"
+
+# "files" writes one PDF per row, "merged" one PDF with a page per row and
+# "spliced" one PDF per row that is the template's own bytes plus an update
+OUTPUT_MODES = ("files", "merged", "spliced")
+
+DEFAULT_SETTINGS = {
+    "font_name": "Helvetica",
+    "custom_fonts": {},
+    "font_size": "12",
+    "x_percent": "10",
+    "y_percent": "20",
+    "max_chars": "80",
+    "wrap_mode": "chars",
+    "line_width": "80",
+    "workers": "1",
+    "output_mode": "files",
+    "merged_filename": "merged.pdf",
+    "archive": "",
+    "archive_filename": "",
+    "shard_by": "",
+    "incremental": True,
+    "row_selection": "",
+    "metrics_dir": "",
+    "filename_prefix": "emprius_{name}.pdf",
+    "template_path": "",
+    "csv_path": "",
+    "source_query": "",
+    "output_dir": "",
+    "text_content": "",
+    "text_format_ranges": {}
+}
+
+
+def save_settings(settings, settings_file=SETTINGS_FILE):
+    """Save settings to JSON file
+
+    The file is written under a temporary name and renamed over the old one,
+    so a crash mid-write never leaves a half written settings file behind.
+    """
+    try:
+        directory = os.path.dirname(os.path.abspath(settings_file))
+        fd, temp_path = tempfile.mkstemp(prefix=".settings-", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(settings, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, settings_file)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    except Exception as e:
+        print(f"Error saving settings: {e}")
+
+
+class SettingsWriter:
+    """Saves settings from a background thread, so the caller never waits on the disk
+
+    Only the latest settings passed to save() are written; ones replaced
+    before the thread got to them are dropped.
+    """
+
+    def __init__(self, settings_file=SETTINGS_FILE):
+        self.settings_file = settings_file
+        self._pending = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wake = threading.Event()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def save(self, settings):
+        with self._lock:
+            self._pending = settings
+        self._wake.set()
+
+    def flush(self):
+        """Write any pending settings now, in the calling thread"""
+        self._write_pending()
+
+    def _write_pending(self):
+        with self._write_lock:
+            with self._lock:
+                settings, self._pending = self._pending, None
+            if settings is not None:
+                save_settings(settings, self.settings_file)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self._write_pending()
+
+
+def read_settings(settings_file):
+    """Read settings from a JSON file, filling in defaults; errors are raised"""
+    with open(settings_file, 'r') as f:
+        settings = json.load(f)
+    if not isinstance(settings, dict):
+        raise ValueError(f"Settings file must contain a JSON object: {settings_file}")
+    # Update with any missing default settings
+    for key, value in DEFAULT_SETTINGS.items():
+        if key not in settings:
+            settings[key] = value
+    return settings
+
+
+def load_settings(settings_file=SETTINGS_FILE):
+    """Load settings from JSON file"""
+    try:
+        if os.path.exists(settings_file):
+            return read_settings(settings_file)
+    except Exception as e:
+        print(f"Error loading settings: {e}")
+
+    return dict(DEFAULT_SETTINGS)
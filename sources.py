@@ -0,0 +1,158 @@
+import csv
+import gzip
+import json
+import os
+import sqlite3
+from contextlib import closing
+
+
+# Rows fetched from SQLite at a time
+SQLITE_BATCH_SIZE = 500
+
+SQLITE_SUFFIXES = (".sqlite", ".sqlite3", ".db")
+JSONL_SUFFIXES = (".jsonl", ".ndjson")
+
+
+def text_value(value):
+    """Return a value read from a JSON or SQLite input as the text a CSV would hold"""
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    if isinstance(value, (bool, dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def _open_text(path):
+    # .gz files are decompressed as they are read
+    if path.lower().endswith(".gz"):
+        return gzip.open(path, mode="rt", encoding="utf-8-sig", newline="")
+    return open(path, mode="r", encoding="utf-8-sig", newline="")
+
+
+class CsvSource:
+    """Rows of a CSV file, gzip compressed or not, in file order
+
+    Only uncompressed files are splittable: their rows can be found by byte
+    offset, for parallel workers and the row index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.splittable = not path.lower().endswith(".gz")
+        with _open_text(path) as f:
+            self.headers = next(csv.reader(f), None)
+
+    def rows(self):
+        with _open_text(self.path) as f:
+            yield from csv.DictReader(f)
+
+
+class JsonlSource:
+    """Rows of a JSON Lines file, one object per line, gzip compressed or not
+
+    The first object's keys are the headers; a key missing from a later
+    object reads as empty and keys the first object lacks are ignored.
+    """
+
+    splittable = False
+
+    def __init__(self, path):
+        self.path = path
+        self.headers = None
+        for number, record in self._records():
+            self.headers = list(record)
+            break
+
+    def _records(self):
+        with _open_text(self.path) as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"Line {number} of {self.path} is not valid JSON: {e}")
+                if not isinstance(record, dict):
+                    raise ValueError(f"Line {number} of {self.path} is not a JSON object")
+                yield number, record
+
+    def rows(self):
+        headers = self.headers
+        for number, record in self._records():
+            yield {header: text_value(record.get(header)) for header in headers}
+
+
+class SqliteSource:
+    """Rows of a query on a SQLite database, fetched in batches
+
+    Without a query, a database holding a single table or view reads all of
+    it; the query's column names are the headers.
+    """
+
+    splittable = False
+
+    def __init__(self, path, query=""):
+        if not os.path.exists(path):
+            raise ValueError(f"Database not found: {path}")
+        self.path = path
+        try:
+            with closing(self._connect()) as connection:
+                self.query = query.strip().rstrip(";").strip() or self._default_query(connection)
+                cursor = connection.execute(f"SELECT * FROM ({self.query}) LIMIT 0")
+                self.headers = [column[0] for column in cursor.description]
+        except sqlite3.Error as e:
+            raise ValueError(f"Cannot read {path}: {e}")
+
+    def _connect(self):
+        from urllib.request import pathname2url
+        # Read only, so a mistyped query can never change the data
+        return sqlite3.connect(f"file:{pathname2url(os.path.abspath(self.path))}?mode=ro", uri=True)
+
+    def _default_query(self, connection):
+        names = [name for name, in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'"
+        )]
+        if len(names) != 1:
+            raise ValueError(f"{self.path} has {len(names)} tables; set source_query to choose the rows")
+        return 'SELECT * FROM "{}"'.format(names[0].replace('"', '""'))
+
+    def rows(self):
+        headers = self.headers
+        connection = self._connect()
+        try:
+            cursor = connection.execute(self.query)
+            while True:
+                batch = cursor.fetchmany(SQLITE_BATCH_SIZE)
+                if not batch:
+                    break
+                for values in batch:
+                    yield dict(zip(headers, map(text_value, values)))
+        except sqlite3.Error as e:
+            raise ValueError(f"Cannot read {self.path}: {e}")
+        finally:
+            connection.close()
+
+    def count(self):
+        with closing(self._connect()) as connection:
+            return connection.execute(f"SELECT COUNT(*) FROM ({self.query})").fetchone()[0]
+
+
+def open_source(path, query=""):
+    """Return the row source for a data file, chosen by its extension
+
+    .sqlite, .sqlite3 and .db are SQLite databases read with query;
+    .jsonl and .ndjson are JSON Lines; anything else is CSV. JSON Lines
+    and CSV files may also be gzip compressed (.csv.gz, .jsonl.gz).
+    """
+    name = path.lower()
+    if name.endswith(SQLITE_SUFFIXES):
+        return SqliteSource(path, query)
+    if name.endswith(".gz"):
+        name = name[:-3]
+    if name.endswith(JSONL_SUFFIXES):
+        return JsonlSource(path)
+    return CsvSource(path)
@@ -0,0 +1,250 @@
+"""Startup time check for the GUI and command line entry points.
+
+Launches each entry point in fresh interpreters and writes the results as JSON:
+
+    python startup.py --output startup.json
+    python startup.py --baseline startup.json
+
+For every case it records the cold launch, the first one with an empty
+bytecode cache so every module is compiled, the median of the warm launches
+that follow and the import time reported by python -X importtime, split by
+package. Each case also lists modules it must not load, such as tkinter on
+the headless paths; loading one fails the check. With --binary the cases run
+a PyInstaller build instead of main.py, without the import breakdown.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules that only drawing a PDF or parsing one needs
+DRAWING_MODULES = ("reportlab.pdfgen", "reportlab.pdfbase")
+PDF_MODULES = ("PyPDF2",) + DRAWING_MODULES
+
+# Warm launch time may grow this much against the baseline before a case is flagged
+DEFAULT_THRESHOLD = 0.20
+
+# Changes smaller than this are launch noise, whatever the ratio
+MIN_REGRESSION_SECONDS = 0.02
+
+DEFAULT_REPEAT = 5
+
+# Packages listed in the import breakdown of each case
+IMPORT_BREAKDOWN_SIZE = 8
+
+
+def make_fixture(workdir):
+    """Write a one page template, a three row CSV and a settings file; returns the settings path"""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    template_path = os.path.join(workdir, "template.pdf")
+    c = canvas.Canvas(template_path, pagesize=letter)
+    c.setFont("Helvetica-Bold", 16)
+    c.drawString(72, letter[1] - 72, "CSV2PDF Startup Letterhead")
+    c.save()
+
+    csv_path = os.path.join(workdir, "data.csv")
+    with open(csv_path, "w", newline="") as f:
+        f.write("name,city\nAna,Madrid\nJordi,Barcelona\nMaite,Bilbao\n")
+
+    settings_path = os.path.join(workdir, "settings.json")
+    with open(settings_path, "w") as f:
+        json.dump({
+            "template_path": template_path,
+            "csv_path": csv_path,
+            "output_dir": os.path.join(workdir, "output"),
+            "filename_prefix": "letter_{name}",
+            "text_content": "\\tDear <b>{name}</b>,\\n\\nWelcome to {city}.",
+        }, f)
+    return settings_path
+
+
+def render_arguments(settings_path, binary=None):
+    # Arguments of a render run after the interpreter or binary
+    entry = [] if binary else [os.path.join(HERE, "main.py")]
+    return entry + ["render", "--settings", settings_path]
+
+
+def build_cases(settings_path, binary=None):
+    """Return the cases as (id, arguments after the interpreter or binary, modules they must not load)"""
+    render = render_arguments(settings_path, binary)
+    entry = render[:-3]
+    cases = [
+        ("cli-help", entry + ["render", "--help"], ("tkinter",) + PDF_MODULES),
+        # Every PDF is up to date after the first launch, so nothing is drawn
+        ("cli-unchanged", render, ("tkinter",) + DRAWING_MODULES),
+        ("cli-render", render + ["--force"], ("tkinter",)),
+    ]
+    if not binary:
+        # The GUI's imports before the window opens
+        cases.insert(0, ("gui-import", ["-c", f"import sys; sys.path.insert(0, {HERE!r}); import main"], PDF_MODULES))
+    return cases
+
+
+def parse_importtime(stderr):
+    """Return the total seconds, microseconds by package and every module name in python -X importtime output"""
+    total = 0
+    self_by_package = {}
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # The header line
+        self_us, cumulative_us, name = int(fields[0]), int(fields[1]), fields[2]
+        module = name.strip()
+        if not name.startswith("  "):
+            total += cumulative_us  # Top-level imports include everything below them
+        package = module.split(".")[0]
+        self_by_package[package] = self_by_package.get(package, 0) + self_us
+        modules.append(module)
+    return total / 1e6, self_by_package, modules
+
+
+def forbidden_loaded(modules, forbidden):
+    # The forbidden names any loaded module is, or belongs to
+    return sorted({
+        name for name in forbidden
+        if any(module == name or module.startswith(name + ".") for module in modules)
+    })
+
+
+def launch(command, env=None):
+    started = time.perf_counter()
+    child = subprocess.run(command, capture_output=True, text=True, env=env, cwd=HERE)
+    elapsed = time.perf_counter() - started
+    if child.returncode != 0:
+        message = child.stderr.strip().splitlines()[-1] if child.stderr.strip() else "failed"
+        raise RuntimeError(f"{' '.join(command)}: {message}")
+    return elapsed, child
+
+
+def run_case(arguments, forbidden, repeat, binary=None):
+    """Launch one case cold, then repeat times warm, and return its measurements"""
+    command = [binary] + arguments if binary else [sys.executable] + arguments
+    cache_dir = tempfile.mkdtemp(prefix="csv2pdf-startup-pycache-")
+    env = dict(os.environ, PYTHONPYCACHEPREFIX=cache_dir)
+    # Warm launches must find the bytecode the cold one wrote
+    for name in ("PYTHONDONTWRITEBYTECODE", "PYTHONPROFILEIMPORTTIME"):
+        env.pop(name, None)
+    try:
+        cold, _ = launch(command, env)
+        warm = [launch(command, env)[0] for _ in range(repeat)]
+        entry = {
+            "cold_seconds": cold,
+            "warm_seconds": statistics.median(warm),
+            "warm_min_seconds": min(warm),
+        }
+        if not binary:
+            _, child = launch([sys.executable, "-X", "importtime"] + arguments, env)
+            import_seconds, self_by_package, modules = parse_importtime(child.stderr)
+            heaviest = sorted(self_by_package.items(), key=lambda item: item[1], reverse=True)
+            entry["import_seconds"] = import_seconds
+            entry["imports_by_package"] = {package: us / 1e6 for package, us in heaviest[:IMPORT_BREAKDOWN_SIZE]}
+            entry["forbidden_loaded"] = forbidden_loaded(modules, forbidden)
+        return entry
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=HERE
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(baseline, results, threshold):
+    """Return a message for every case whose warm launch grew more than threshold over baseline"""
+    previous = {case["id"]: case for case in baseline.get("cases", []) if "warm_seconds" in case}
+    regressions = []
+    for case in results["cases"]:
+        old = previous.get(case["id"])
+        if old is None or "warm_seconds" not in case or not old["warm_seconds"]:
+            continue
+        change = case["warm_seconds"] / old["warm_seconds"] - 1
+        if change > threshold and case["warm_seconds"] - old["warm_seconds"] > MIN_REGRESSION_SECONDS:
+            regressions.append(
+                f"{case['id']}: {old['warm_seconds'] * 1000:.0f} -> {case['warm_seconds'] * 1000:.0f} ms ({change:+.1%})"
+            )
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Measure how long the CSV2PDF entry points take to start.")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help=f"warm launches per case (default: {DEFAULT_REPEAT})")
+    parser.add_argument("--binary", help="time this PyInstaller build instead of main.py")
+    parser.add_argument("--output", default="startup_results.json", help="results JSON (default: startup_results.json)")
+    parser.add_argument("--baseline", help="earlier results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed warm launch growth against the baseline (default: 0.20)")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.repeat < 1:
+        raise SystemExit("--repeat must be at least 1")
+    binary = os.path.abspath(args.binary) if args.binary else None
+
+    workdir = tempfile.mkdtemp(prefix="csv2pdf-startup-")
+    try:
+        settings_path = make_fixture(workdir)
+        cases = build_cases(settings_path, binary)
+        # Render the fixture once, so the unchanged case finds every PDF up to date
+        launch([binary or sys.executable] + render_arguments(settings_path, binary))
+        results = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "binary": binary,
+            "cases": [],
+        }
+        failures = []
+        for case_id, arguments, forbidden in cases:
+            print(f"{case_id} ...", end=" ", flush=True)
+            entry = {"id": case_id}
+            try:
+                entry.update(run_case(arguments, forbidden, args.repeat, binary))
+            except RuntimeError as e:
+                entry["error"] = str(e)
+                failures.append(f"{case_id}: {e}")
+                print(f"error: {e}")
+            else:
+                text = f"cold {entry['cold_seconds'] * 1000:.0f} ms, warm {entry['warm_seconds'] * 1000:.0f} ms"
+                if "import_seconds" in entry:
+                    text += f", imports {entry['import_seconds'] * 1000:.0f} ms"
+                print(text)
+                if entry.get("forbidden_loaded"):
+                    failures.append(f"{case_id} loaded {', '.join(entry['forbidden_loaded'])}")
+            results["cases"].append(entry)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures.extend(f"Regression: {message}" for message in compare(json.load(f), results, args.threshold))
+    for message in failures:
+        print(message)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())